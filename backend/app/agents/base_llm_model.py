@@ -1,16 +1,22 @@
+import asyncio
 import os
 import io
-from typing import Optional, List, Dict, Any, Iterator, AsyncIterator
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple, Union
 from abc import ABC, abstractmethod
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from dataclasses import dataclass, field
+from functools import lru_cache
 import json
 import logging
+import time
 
+import httpx
 from google import genai
 from google.genai import types
 from google.genai.errors import ClientError, ServerError
 
+from .session_store import SessionStore, InMemorySessionStore, RedisSessionStore
+
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -18,36 +24,333 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@lru_cache(maxsize=128)
+def _canonical_system_prompt(system_prompt: str) -> str:
+    """
+    Normalise a system prompt so identical prompts are byte-identical across calls.
+    Gemini's implicit prefix cache only hits when the leading tokens match exactly.
+    """
+    return "\n".join(line.rstrip() for line in system_prompt.strip().splitlines())
+
+
+def _join_system_context(system_prompt: Optional[str], context: str) -> str:
+    """Place retrieved context after the (stable) system prompt so the shared prefix stays cacheable."""
+    if not system_prompt:
+        return context
+    return f"{system_prompt}\n\n{context}"
+
+
+@lru_cache(maxsize=1024)
+def _history_content(api_role: str, text: str) -> types.Content:
+    """
+    Build (once) the API Content for a history turn. Turns are immutable once recorded,
+    so identical turns (e.g. repeated greetings, injected system notes) share one object.
+    """
+    return types.Content(role=api_role, parts=[types.Part.from_text(text=text)])
+
+
+@lru_cache(maxsize=128)
+def _build_generation_config(
+    temperature: float,
+    top_p: float,
+    top_k: float,
+    max_output_tokens: Optional[int],
+    system_prompt: Optional[str],
+    cached_content: Optional[str] = None
+) -> types.GenerateContentConfig:
+    """
+    Build (and memoise) the chat generation config. Nearly every call uses the same
+    parameters, so this skips re-running pydantic validation on the hot path.
+    """
+    config_params: Dict[str, Any] = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        "thinking_config": types.ThinkingConfig(thinking_budget=0),
+    }
+
+    if max_output_tokens is not None:
+        config_params["max_output_tokens"] = max_output_tokens
+
+    if system_prompt:
+        config_params["system_instruction"] = _canonical_system_prompt(system_prompt)
+
+    if cached_content:
+        config_params["cached_content"] = cached_content
+
+    return types.GenerateContentConfig(**config_params)
+
+
+def _encode_metadata(value: Any) -> Any:
+    """Make session metadata JSON-safe (uploaded Gemini files are stored as tagged dicts)."""
+    if isinstance(value, types.File):
+        return {"__genai_file__": value.model_dump(mode="json", exclude_none=True)}
+    if isinstance(value, dict):
+        return {k: _encode_metadata(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_metadata(v) for v in value]
+    return value
+
+
+def _decode_metadata(value: Any) -> Any:
+    if isinstance(value, dict):
+        if "__genai_file__" in value:
+            return types.File(**value["__genai_file__"])
+        return {k: _decode_metadata(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode_metadata(v) for v in value]
+    return value
+
+
+@lru_cache(maxsize=128)
+def _build_stateless_config(
+    temperature: float,
+    max_output_tokens: int,
+    system_prompt: Optional[str],
+    response_mime_type: Optional[str],
+    cached_content: Optional[str],
+    response_schema: Optional[type] = None
+) -> types.GenerateContentConfig:
+    """Memoised config for one-off (stateless) calls; agents reuse a handful of fixed shapes."""
+    config_params: Dict[str, Any] = {
+        "temperature": temperature,
+        "max_output_tokens": max_output_tokens,
+        "top_p": 0.95,
+        "top_k": 40,
+        # "thinking_config": types.ThinkingConfig(thinking_budget=0), 
+    }
+
+    if system_prompt:
+        config_params["system_instruction"] = _canonical_system_prompt(system_prompt)
+
+    if response_mime_type:
+        config_params["response_mime_type"] = response_mime_type
+
+    if response_schema is not None:
+        config_params["response_schema"] = response_schema
+
+    if cached_content:
+        config_params["cached_content"] = cached_content
+
+    return types.GenerateContentConfig(**config_params)
+
+
+def _stateless_contents(
+    prompt: str,
+    attachments: Optional[List[types.File]]
+) -> Union[str, List[types.Content]]:
+    """
+    Contents for a one-off call. Without attachments the prompt is passed as a bare
+    string (the SDK wraps it as a single user turn); system prompts travel in the config.
+    """
+    if not attachments:
+        return prompt
+
+    message_parts = [
+        types.Part.from_uri(file_uri=file_ref.uri, mime_type=file_ref.mime_type)
+        for file_ref in attachments
+    ]
+    message_parts.append(types.Part.from_text(text=prompt))
+    return [types.Content(role="user", parts=message_parts)]
+
+
+async def _iter_text(stream: AsyncIterator[types.GenerateContentResponse]) -> AsyncIterator[str]:
+    """Yield only the non-empty text deltas of a Gemini stream (skips empty / tool-call chunks upstream)."""
+    async for chunk in stream:
+        text = chunk.text
+        if text:
+            yield text
+
+
+def _to_epoch(value: Any) -> float:
+    """Accept both the current epoch-seconds form and older ISO-string timestamps."""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+    return float(value)
+
+
+@dataclass(slots=True)
+class ChatMessage:
+    """A single chat history turn. Slotted to keep per-message overhead small on long sessions."""
+    role: str
+    content: str
+    ts_ns: int = field(default_factory=time.time_ns)
+
+    @property
+    def timestamp_iso(self) -> str:
+        """Wall-clock timestamp, formatted only when something actually asks for it."""
+        return datetime.utcfromtimestamp(self.ts_ns / 1e9).isoformat()
+
+
+# Rough history budget; older turns are dropped once exceeded so each call doesn't re-send everything
+DEFAULT_CONTEXT_BUDGET_TOKENS = 32_000
+
+
+def _estimate_tokens(text: str) -> int:
+    """Cheap ~4 chars/token heuristic, avoids a tokenizer call per message."""
+    return len(text) // 4 + 1
+
+
+# Gemini rejects explicit caches below a per-model minimum (1024 tokens on Flash, 2048 on Pro);
+# smaller prompts are sent inline without attempting a create
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_PROMPT_CACHE_MIN_TOKENS", "2048"))
+
+
+@dataclass(slots=True)
 class ChatSession:
     """
     Represents an isolated chat session tied to a study group or context.
     Maintains chat history independent of other sessions.
+    Slotted (no per-instance __dict__) since up to max_sessions of these stay resident.
     """
     session_id: str
     group_id: int
     created_at: datetime = field(default_factory=datetime.utcnow)
-    chat_history: List[Dict[str, str]] = field(default_factory=list)
+    # Epoch seconds (time.time() is far cheaper than building a datetime on every turn)
+    last_accessed: float = field(default_factory=time.time)
+    chat_history: List[ChatMessage] = field(default_factory=list)
     metadata: Dict[str, Any] = field(default_factory=dict)
+    context_budget: int = DEFAULT_CONTEXT_BUDGET_TOKENS
+
+    # Estimated tokens currently held in chat_history
+    _running_tokens: int = field(default=0, init=False, repr=False)
+
+    # API contents already built from chat_history[:_last_built_len]
+    _contents_cache: List[types.Content] = field(default_factory=list, init=False, repr=False)
+    _last_built_len: int = field(default=0, init=False, repr=False)
+
+    # Last (user_message, system_prompt, reply, monotonic time), for answering an immediate resubmit
+    # (retry, double-click) without an API call
+    _last_reply: Optional[Tuple[str, Optional[str], str, float]] = field(default=None, init=False, repr=False)
+    REPLY_DEDUPE_SECONDS = 30.0
+
+    def __post_init__(self) -> None:
+        self._running_tokens = sum(_estimate_tokens(m.content) for m in self.chat_history)
     
     def add_message(self, role: str, content: str) -> None:
-        """Add a message to the chat history."""
-        self.chat_history.append({
-            "role": role,
-            "content": content,
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        """Add a message to the chat history (oldest turns are trimmed past the token budget)."""
+        self.last_accessed = time.time()
+        self.chat_history.append(ChatMessage(role=role, content=content))
+        self._running_tokens += _estimate_tokens(content)
+        if self._running_tokens > self.context_budget:
+            self._trim_to_budget()
+
+    def set_context_budget(self, tokens: int) -> None:
+        """Change the history token budget, trimming immediately if already over it."""
+        self.context_budget = tokens
+        if self._running_tokens > self.context_budget:
+            self._trim_to_budget()
+
+    def _trim_to_budget(self) -> None:
+        """
+        Drop the oldest turns until the history fits the budget. A leading 'system' message is kept,
+        the newest message is always kept, and the history never starts on an assistant turn.
+        """
+        history = self.chat_history
+        start = 1 if history and history[0].role == "system" else 0
+        end = start
+        tokens = self._running_tokens
+
+        while end < len(history) - 1 and tokens > self.context_budget:
+            tokens -= _estimate_tokens(history[end].content)
+            end += 1
+        while end < len(history) - 1 and history[end].role == "assistant":
+            tokens -= _estimate_tokens(history[end].content)
+            end += 1
+
+        dropped = end - start
+        if dropped == 0:
+            return
+        del history[start:end]
+        self._running_tokens = tokens
+
+        # Keep the built contents cache aligned with the trimmed history
+        if self._last_built_len >= end:
+            del self._contents_cache[start:end]
+            self._last_built_len -= dropped
+        else:
+            self._contents_cache = []
+            self._last_built_len = 0
     
-    def get_history(self) -> List[Dict[str, str]]:
-        """Get chat history without timestamps for API calls."""
-        return [
-            {"role": msg["role"], "content": msg["content"]}
+    def get_history(self) -> Tuple[Dict[str, str], ...]:
+        """Get chat history without timestamps for API calls (read-only; callers only iterate it)."""
+        self.last_accessed = time.time()
+        return tuple(
+            {"role": msg.role, "content": msg.content}
             for msg in self.chat_history
-        ]
+        )
     
     def clear_history(self) -> None:
         """Clear chat history for this session."""
         self.chat_history = []
+        self._running_tokens = 0
+        self._contents_cache = []
+        self._last_built_len = 0
+        self._last_reply = None
+
+    def get_cached_reply(self, user_message: str, system_prompt: Optional[str]) -> Optional[str]:
+        """
+        Return the previous reply if this turn resubmits the previous user turn (same message
+        and prompt) within REPLY_DEDUPE_SECONDS and nothing has been added to the history since.
+        A message repeated later in the conversation ("why?", "continue") is answered afresh.
+        """
+        last = self._last_reply
+        if last is None:
+            return None
+        last_message, last_prompt, reply, answered_at = last
+        if (
+            time.monotonic() - answered_at > self.REPLY_DEDUPE_SECONDS
+            or last_message != user_message
+            or last_prompt != system_prompt
+            or len(self.chat_history) < 2
+            or self.chat_history[-1].role != "assistant"
+            or self.chat_history[-1].content != reply
+            or self.chat_history[-2].content != user_message
+        ):
+            return None
+        return reply
+
+    def remember_reply(self, user_message: str, system_prompt: Optional[str], reply: str) -> None:
+        self._last_reply = (user_message, system_prompt, reply, time.monotonic())
+
+    def get_history_contents(self) -> List[types.Content]:
+        """Get chat history as API contents, converting only the turns added since the last call."""
+        if self._last_built_len > len(self.chat_history):
+            # History was replaced/trimmed externally, rebuild from scratch
+            self._contents_cache = []
+            self._last_built_len = 0
+
+        for msg in self.chat_history[self._last_built_len:]:
+            # Map 'assistant' to 'model' for the API
+            api_role = "model" if msg.role == "assistant" else "user"
+            self._contents_cache.append(_history_content(api_role, msg.content))
+        self._last_built_len = len(self.chat_history)
+
+        return self._contents_cache
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialise for an external session store."""
+        return {
+            "session_id": self.session_id,
+            "group_id": self.group_id,
+            "created_at": self.created_at.isoformat(),
+            "last_accessed": self.last_accessed,
+            "chat_history": [[m.role, m.content, m.ts_ns] for m in self.chat_history],
+            "context_budget": self.context_budget,
+            "metadata": _encode_metadata(self.metadata),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ChatSession":
+        return cls(
+            session_id=data["session_id"],
+            group_id=data["group_id"],
+            created_at=datetime.fromisoformat(data["created_at"]),
+            last_accessed=_to_epoch(data["last_accessed"]),
+            chat_history=[ChatMessage(role=r, content=c, ts_ns=ts) for r, c, ts in data["chat_history"]],
+            metadata=_decode_metadata(data.get("metadata") or {}),
+            context_budget=data.get("context_budget", DEFAULT_CONTEXT_BUDGET_TOKENS),
+        )
     
     def get_summary(self) -> Dict[str, Any]:
         """Get session summary information."""
@@ -55,6 +358,7 @@ class ChatSession:
             "session_id": self.session_id,
             "group_id": self.group_id,
             "created_at": self.created_at.isoformat(),
+            "last_accessed": datetime.utcfromtimestamp(self.last_accessed).isoformat(),
             "message_count": len(self.chat_history),
             "metadata": self.metadata
         }
@@ -81,7 +385,8 @@ class BaseLLMModel:
         top_k: float = 40,
         max_output_tokens: Optional[int] = None,
         timeout: int = 60,
-        max_sessions: int = 100
+        max_sessions: int = 100,
+        session_store: Optional[SessionStore] = None
     ):
         """
         Initialize the Base LLM Model.
@@ -90,14 +395,24 @@ class BaseLLMModel:
             api_key: Google API key. If None, uses GOOGLE_API_KEY env var.
             model_name: Name of the model to use
             default_temperature: Default temperature for responses
-            max_sessions: Maximum number of concurrent sessions
+            max_sessions: Maximum number of sessions kept in memory (least recently used are evicted)
+            session_store: Where sessions live. Defaults to SESSION_STORE env var ("memory" or "redis").
         """
         self.api_key = api_key or os.getenv("GEMINI_API_KEY")
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY not provided and not found in environment")
         
         
-        self.client = genai.Client(api_key=self.api_key)
+        # Keep-alive pool sized for bursts (tune with GEMINI_HTTP_POOL_SIZE)
+        pool_size = int(os.getenv("GEMINI_HTTP_POOL_SIZE", "32"))
+        limits = httpx.Limits(max_keepalive_connections=pool_size, max_connections=pool_size * 2)
+        self.client = genai.Client(
+            api_key=self.api_key,
+            http_options=types.HttpOptions(
+                client_args={"limits": limits},
+                async_client_args={"limits": limits}
+            )
+        )
         self.model_name = model_name
 
         self.fallback_chain = [
@@ -112,14 +427,41 @@ class BaseLLMModel:
         self.timeout = timeout
         self.max_sessions = max_sessions
         
-        # Session storage: {session_id: ChatSession}
-        self.sessions: Dict[str, ChatSession] = {}
+        # Session storage (in-process LRU by default, Redis when shared across workers)
+        self.session_store: SessionStore = session_store or self._default_session_store()
+
+        # Explicit Gemini context caches for static system prompts: {prompt: (cache name or None, expires_at)}
+        self._prompt_caches: Dict[str, Tuple[Optional[str], float]] = {}
+        # In-flight creates, so concurrent cold misses for one prompt share a single API call
+        self._prompt_cache_creates: Dict[str, asyncio.Task] = {}
         
         logger.info(f"Initialized BaseLLMModel with model: {model_name}")
     
+    async def warmup(self) -> None:
+        """
+        Open a pooled TLS connection to the Gemini API ahead of the first real request,
+        so the first user doesn't pay the DNS + TCP + TLS handshake.
+        """
+        try:
+            await self.client.aio.models.get(model=self.fallback_chain[0])
+            logger.info("Gemini connection pool warmed up")
+        except Exception as e:
+            logger.warning(f"Gemini warm-up failed (first request will open the connection): {e}")
+
     # ========================
     # Session Management
     # ========================
+
+    def _default_session_store(self) -> SessionStore:
+        if os.getenv("SESSION_STORE", "memory").lower() == "redis":
+            redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+            logger.info(f"Using Redis session store at {redis_url}")
+            return RedisSessionStore(redis_url, session_factory=ChatSession.from_dict)
+        return InMemorySessionStore(max_sessions=self.max_sessions)
+
+    def save_session(self, session: ChatSession) -> None:
+        """Persist a session after mutating it (required for external stores)."""
+        self.session_store.put(session)
     
     def create_session(
         self,
@@ -137,38 +479,72 @@ class BaseLLMModel:
             
         Returns:
             Created ChatSession object
-            
-        Raises:
-            RuntimeError: If max sessions reached
         """
-        if len(self.sessions) >= self.max_sessions:
-            logger.warning(f"Max sessions ({self.max_sessions}) reached")
-            raise RuntimeError(f"Maximum sessions ({self.max_sessions}) reached")
-        
-        if session_id in self.sessions:
+        existing = self.session_store.get(session_id)
+        if existing is not None:
             logger.warning(f"Session {session_id} already exists, returning existing")
-            return self.sessions[session_id]
+            return existing
         
         session = ChatSession(
             session_id=session_id,
             group_id=group_id,
             metadata=metadata or {}
         )
-        self.sessions[session_id] = session
-        logger.info(f"Created session {session_id} for group {group_id}")
+        self.session_store.put(session)
+        logger.info("Created session %s for group %s", session_id, group_id)
         return session
     
     def get_session(self, session_id: str) -> Optional[ChatSession]:
-        """Get an existing chat session."""
-        return self.sessions.get(session_id)
+        """Get an existing chat session (marks it as most recently used)."""
+        return self.session_store.get(session_id)
+
+    def get_or_create_session(self, session_id: str, group_id: int) -> ChatSession:
+        """Existing session, or a new one for the group; a single store lookup either way."""
+        session = self.session_store.get(session_id)
+        if session is None:
+            session = ChatSession(session_id=session_id, group_id=group_id, metadata={})
+            self.session_store.put(session)
+            logger.info("Created session %s for group %s", session_id, group_id)
+        return session
     
+    # Async counterparts for use on the event loop: a blocking (network) store is called from a
+    # worker thread, the in-process store directly
+    async def _run_store_op(self, fn, *args):
+        if self.session_store.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def aget_session(self, session_id: str) -> Optional[ChatSession]:
+        return await self._run_store_op(self.get_session, session_id)
+
+    async def aget_or_create_session(self, session_id: str, group_id: int) -> ChatSession:
+        return await self._run_store_op(self.get_or_create_session, session_id, group_id)
+
+    async def asave_session(self, session: ChatSession) -> None:
+        await self._run_store_op(self.save_session, session)
+
+    async def aadd_message_to_history(self, session_id: str, role: str, content: str) -> bool:
+        return await self._run_store_op(self.add_message_to_history, session_id, role, content)
+
     def delete_session(self, session_id: str) -> bool:
         """Delete a chat session and clear its history."""
-        if self.sessions.pop(session_id, None) is not None:
+        if self.session_store.delete(session_id):
             logger.info(f"Deleted session {session_id}")
             return True
         return False
     
+    def evict_idle(self, older_than: timedelta) -> int:
+        """
+        Drop sessions that have not been accessed within `older_than`.
+        
+        Returns:
+            Number of sessions evicted
+        """
+        evicted = self.session_store.evict_idle(older_than)
+        if evicted:
+            logger.info(f"Evicted {evicted} idle sessions")
+        return evicted
+    
     def list_sessions(self, group_id: Optional[int] = None) -> List[ChatSession]:
         """
         List all sessions, optionally filtered by group.
@@ -179,11 +555,9 @@ class BaseLLMModel:
         Returns:
             List of ChatSession objects
         """
-        if group_id is None:
-            return list(self.sessions.values())
-        return [s for s in self.sessions.values() if s.group_id == group_id]
+        return self.session_store.list(group_id)
     
-    def get_session_history(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+    def get_session_history(self, session_id: str) -> Optional[Tuple[Dict[str, str], ...]]:
         """Get the chat history for a session."""
         session = self.get_session(session_id)
         if session is None:
@@ -196,6 +570,7 @@ class BaseLLMModel:
         if session is None:
             return False
         session.clear_history()
+        self.save_session(session)
         logger.info(f"Cleared history for session {session_id}")
         return True
     
@@ -222,6 +597,7 @@ class BaseLLMModel:
         session = self.get_session(session_id)
         if session:
             session.add_message(role, content)
+            self.save_session(session)
             return True
         logger.warning(f"Attempted to add message to non-existent session {session_id}")
         return False
@@ -230,6 +606,58 @@ class BaseLLMModel:
     # Core LLM Functionality
     # ========================
 
+    @staticmethod
+    def is_prompt_cacheable(system_prompt: str) -> bool:
+        """Whether the prompt is large enough for an explicit Gemini context cache."""
+        return _estimate_tokens(_canonical_system_prompt(system_prompt)) >= PROMPT_CACHE_MIN_TOKENS
+
+    async def get_prompt_cache(self, system_prompt: str, ttl_seconds: int = 3600) -> Optional[str]:
+        """
+        Register a static system prompt with Gemini's explicit context cache on the primary model
+        and return the cache name, so later calls skip re-prefilling it.
+        Returns None (send the prompt inline) for prompts below the minimum cacheable size, without
+        an API call, or if the create fails; a failure is remembered until the TTL passes.
+        """
+        if not self.is_prompt_cacheable(system_prompt):
+            return None
+
+        key = _canonical_system_prompt(system_prompt)
+        entry = self._prompt_caches.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+
+        task = self._prompt_cache_creates.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._create_prompt_cache(key, ttl_seconds))
+            self._prompt_cache_creates[key] = task
+            task.add_done_callback(lambda _t, k=key: self._prompt_cache_creates.pop(k, None))
+        # Shielded: one cancelled caller must not cancel the create the others are waiting on
+        return await asyncio.shield(task)
+
+    async def _create_prompt_cache(self, key: str, ttl_seconds: int) -> Optional[str]:
+        now = time.monotonic()
+        try:
+            cache = await self.client.aio.caches.create(
+                model=self.fallback_chain[0],
+                config=types.CreateCachedContentConfig(
+                    system_instruction=key,
+                    ttl=f"{ttl_seconds}s"
+                )
+            )
+            # Refresh a minute early so we never reference an expired cache
+            self._prompt_caches[key] = (cache.name, now + ttl_seconds - 60)
+            logger.info("Created explicit prompt cache %s", cache.name)
+            return cache.name
+        except Exception as e:
+            logger.info("Explicit prompt cache unavailable, sending system prompt inline: %s", e)
+            self._prompt_caches[key] = (None, now + ttl_seconds)
+            return None
+
+    def _forget_prompt_cache(self, cache_name: str) -> None:
+        for key, (name, _) in list(self._prompt_caches.items()):
+            if name == cache_name:
+                del self._prompt_caches[key]
+
     # Helper to upload files from as an attachment in model API calls
     def upload_file_from_bytes(self, file_bytes: bytes, mime_type: str, display_name: str = "attachment") -> types.File:
         try:
@@ -238,7 +666,20 @@ class BaseLLMModel:
                 file=file_io,
                 config=types.UploadFileConfig(display_name=display_name, mime_type=mime_type)
             )
-            logger.info(f"Uploaded file {display_name} ({mime_type}) with URI {file_upload.uri}")
+            logger.info("Uploaded file %s (%s) with URI %s", display_name, mime_type, file_upload.uri)
+            return file_upload
+        except Exception as e:
+            logger.error(f"Failed to upload file bytes: {str(e)}")
+            raise RuntimeError(f"File upload failed: {str(e)}")
+
+    async def aupload_file_from_bytes(self, file_bytes: bytes, mime_type: str, display_name: str = "attachment") -> types.File:
+        """Async variant of upload_file_from_bytes, so several uploads can run concurrently on the event loop."""
+        try:
+            file_upload = await self.client.aio.files.upload(
+                file=io.BytesIO(file_bytes),
+                config=types.UploadFileConfig(display_name=display_name, mime_type=mime_type)
+            )
+            logger.info("Uploaded file %s (%s) with URI %s", display_name, mime_type, file_upload.uri)
             return file_upload
         except Exception as e:
             logger.error(f"Failed to upload file bytes: {str(e)}")
@@ -254,16 +695,9 @@ class BaseLLMModel:
         ) -> list[types.Content]:
         contents: list[types.Content] = []
         
-        # 1. Add Chat History (if enabled)
+        # 1. Add Chat History (if enabled). Built incrementally on the session, so only new turns are converted.
         if use_chat_history and len(session.chat_history) > 0:
-            for msg in session.chat_history:
-                role = msg["role"]
-                text = msg["content"]
-                # Map 'assistant' to 'model' for the API
-                api_role = "model" if role == "assistant" else "user"
-                
-                # History usually just has text, but you could expand this if you save file references in history
-                contents.append(types.Content(role=api_role, parts=[types.Part.from_text(text=text)]))
+            contents.extend(session.get_history_contents())
 
         # 2. Build the Current Message Parts
         current_message_parts = []
@@ -291,6 +725,33 @@ class BaseLLMModel:
         
         return contents
     
+    def _chat_attempts(
+        self,
+        temperature: Optional[float],
+        top_p: Optional[float],
+        top_k: Optional[float],
+        max_output_tokens: Optional[int],
+        system_prompt: Optional[str],
+        cached_content: Optional[str]
+    ) -> Tuple[types.GenerateContentConfig, List[Tuple[str, types.GenerateContentConfig]]]:
+        """
+        Inline-prompt config plus the (model, config) cascade. With `cached_content` the
+        primary model references the cache; fallback models, which the cache doesn't
+        belong to, still get the prompt inline.
+        """
+        params = (
+            temperature if temperature is not None else self.default_temperature,
+            top_p if top_p is not None else self.top_p,
+            top_k if top_k is not None else self.top_k,
+            max_output_tokens if max_output_tokens is not None else self.max_output_tokens,
+        )
+        generation_config = _build_generation_config(*params, system_prompt)
+
+        attempts = [(model, generation_config) for model in self.fallback_chain]
+        if cached_content:
+            attempts[0] = (self.fallback_chain[0], _build_generation_config(*params, None, cached_content))
+        return generation_config, attempts
+
     async def generate_response(
         self,
         session_id: str,
@@ -302,7 +763,8 @@ class BaseLLMModel:
         max_output_tokens: Optional[int] = 2048,
         timeout: Optional[int] = None,
         use_chat_history: bool = True,
-        attachments: Optional[List[types.File]] = None
+        attachments: Optional[List[types.File]] = None,
+        cached_content: Optional[str] = None
     ) -> str:
         """
         Generate a response from the LLM.
@@ -314,6 +776,8 @@ class BaseLLMModel:
             temperature: Temperature for response generation (overrides default)
             max_tokens: Maximum tokens in response
             use_chat_history: Whether to use chat history from session
+            cached_content: Explicit cache of `system_prompt` (from get_prompt_cache), used on
+                the primary model instead of sending the prompt inline
             
         Returns:
             Generated response text
@@ -322,9 +786,16 @@ class BaseLLMModel:
             ValueError: If session not found
             RuntimeError: If API call fails
         """
-        session = self.get_session(session_id)
+        session = await self.aget_session(session_id)
         if session is None:
             raise ValueError(f"Session {session_id} not found")
+
+        # Resubmitted turn (retry, double-click): answer from the session without another API call
+        if not attachments:
+            cached_reply = session.get_cached_reply(user_message, system_prompt)
+            if cached_reply is not None:
+                logger.info("Duplicate user turn in session %s, returning previous reply", session_id)
+                return cached_reply
         
         # Add user message to history
         session.add_message("user", user_message)
@@ -338,41 +809,34 @@ class BaseLLMModel:
             attachments=attachments,
         )
         
-        # Prepare generation config
-        config_params: Dict[str, Any] = {
-            "temperature": temperature if temperature is not None else self.default_temperature,
-            "top_p": top_p if top_p is not None else self.top_p,
-            "top_k": top_k if top_k is not None else self.top_k,
-            "thinking_config": types.ThinkingConfig(thinking_budget=0),
-        }
-        
-        if max_output_tokens is not None:
-            config_params["max_output_tokens"] = max_output_tokens
-        elif self.max_output_tokens is not None:
-            config_params["max_output_tokens"] = self.max_output_tokens
-        
-        if system_prompt:
-            config_params["system_instruction"] = system_prompt
-        
-        generation_config = types.GenerateContentConfig(**config_params)
+        # Prepare generation config (memoised on the parameter tuple)
+        generation_config, attempts = self._chat_attempts(
+            temperature, top_p, top_k, max_output_tokens, system_prompt, cached_content
+        )
 
         # Cascade through fallback models
         last_exception = None
+        i = 0
     
-        for model in self.fallback_chain:
+        while i < len(attempts):
+            model, config = attempts[i]
+            i += 1
             try:
-                logger.info(f"Attempting generation with model: {model}")
+                logger.info("Attempting generation with model: %s", model)
                 
-                response = await self.client.models.generate_content(
+                # Async client: the sync one would block the event loop for the whole RTT
+                response = await self.client.aio.models.generate_content(
                     model=model,
                     contents=contents,
-                    config=generation_config, 
+                    config=config, 
                 )
                 
                 response_text = response.text if response.text else ""
                 
                 # Success! Save to history and return
                 session.add_message("assistant", response_text)
+                session.remember_reply(user_message, system_prompt, response_text)
+                await self.asave_session(session)
                 return response_text
 
             except (ClientError, ServerError) as e:
@@ -381,6 +845,14 @@ class BaseLLMModel:
                     logger.warning(f"Rate limit/Error hit on {model} (Status: {e.code}). Falling back...")
                     last_exception = e
                     continue # Try next model
+
+                if cached_content and config is not generation_config:
+                    # Cache expired/evicted server-side: forget it and retry this model with the prompt inline
+                    logger.warning(f"Cached content {cached_content} rejected on {model}: {e}. Retrying inline...")
+                    self._forget_prompt_cache(cached_content)
+                    attempts.insert(i, (model, generation_config))
+                    last_exception = e
+                    continue
                 
                 # Treat other 5xx errors as retriable if you want, or raise them. 
                 # For safety, we usually raise 4xx errors (like 400 Invalid Argument) immediately.
@@ -431,13 +903,12 @@ class BaseLLMModel:
         Returns:
             Generated response text
         """
-        # Prepend context to user message
-        message_with_context = f"{context}\n\nUser Question: {user_message}"
-        
+        # Context goes into the system instruction (after the stable system prompt) so the
+        # prompt prefix stays identical across calls and the user turn comes last.
         return await self.generate_response(
             session_id=session_id,
-            user_message=message_with_context,
-            system_prompt=system_prompt,
+            user_message=user_message,
+            system_prompt=_join_system_context(system_prompt, context),
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
@@ -457,16 +928,25 @@ class BaseLLMModel:
         top_k: Optional[float] = None,
         max_output_tokens: Optional[int] = 2048,
         use_chat_history: bool = True,
-        attachments: Optional[List[types.File]] = None
-        
+        attachments: Optional[List[types.File]] = None,
+        cached_content: Optional[str] = None
     ) -> AsyncIterator[str]:
         """
         Stream a response as text deltas with cascading fallback support.
+        `cached_content` is used as in generate_response.
         """
-        session = self.get_session(session_id)
+        session = await self.aget_session(session_id)
         if session is None:
             raise ValueError(f"Session {session_id} not found")
 
+        # Resubmitted turn (retry, double-click): replay the previous reply without another API call
+        if not attachments:
+            cached_reply = session.get_cached_reply(user_message, system_prompt)
+            if cached_reply is not None:
+                logger.info("Duplicate user turn in session %s, replaying previous reply", session_id)
+                yield cached_reply
+                return
+
         # 1. Record User Message (Do this once, regardless of how many retries)
         session.add_message("user", user_message)
 
@@ -478,52 +958,39 @@ class BaseLLMModel:
             attachments=attachments,
         )
 
-        # 3. Prepare Base Config
-        config_params: Dict[str, Any] = {
-            "temperature": temperature if temperature is not None else self.default_temperature,
-            "top_p": top_p if top_p is not None else self.top_p,
-            "top_k": top_k if top_k is not None else self.top_k,
-            # Note: Ensure 'thinking_config' is supported by Flash/Lite or handle potential warnings
-            "thinking_config": types.ThinkingConfig(thinking_budget=0),
-        }
-        
-        if max_output_tokens is not None:
-            config_params["max_output_tokens"] = max_output_tokens
-        elif self.max_output_tokens is not None:
-            config_params["max_output_tokens"] = self.max_output_tokens
-            
-        if system_prompt:
-            config_params["system_instruction"] = system_prompt
-
-        generation_config = types.GenerateContentConfig(**config_params)
+        # 3. Prepare Base Config (memoised on the parameter tuple)
+        generation_config, attempts = self._chat_attempts(
+            temperature, top_p, top_k, max_output_tokens, system_prompt, cached_content
+        )
 
         # === CASCADE LOOP ===
-        accumulated = []
+        accumulated = io.StringIO()
+        chunk_count = 0
         last_exception = None
         
         # We need to know if we successfully started streaming to avoid duplicates
         stream_completed_successfully = False
 
-        for model in self.fallback_chain:
+        i = 0
+        while i < len(attempts):
+            model, config = attempts[i]
+            i += 1
             has_yielded_content = False # Track if this specific model output anything
             
             try:
-                logger.info(f"Attempting stream with model: {model}")
+                logger.info("Attempting stream with model: %s", model)
                 
                 # Get the stream iterator
                 stream = await self.client.aio.models.generate_content_stream(
                     model=model,
                     contents=contents,
-                    config=generation_config,
+                    config=config,
                 )
 
-                async for chunk in stream:
-                    delta = getattr(chunk, "text", None)
-                    if not delta:
-                        continue
-                    
+                async for delta in _iter_text(stream):
                     has_yielded_content = True
-                    accumulated.append(delta)
+                    accumulated.write(delta)
+                    chunk_count += 1
                     yield delta
                 
                 # Finish loop
@@ -544,6 +1011,13 @@ class BaseLLMModel:
                     logger.warning(f"Rate limit hit on {model} (start of stream). Falling back...")
                     last_exception = e
                     continue
+                elif cached_content and config is not generation_config and not has_yielded_content:
+                    # Cache expired/evicted server-side: forget it and retry this model with the prompt inline
+                    logger.warning(f"Cached content {cached_content} rejected on {model}: {e}. Retrying inline...")
+                    self._forget_prompt_cache(cached_content)
+                    attempts.insert(i, (model, generation_config))
+                    last_exception = e
+                    continue
                 else:
                     # Non-retriable error (e.g., Invalid Argument)
                     logger.error(f"Non-retriable error on {model}: {e}")
@@ -560,9 +1034,11 @@ class BaseLLMModel:
 
         # 4. Finalize
         if stream_completed_successfully:
-            final_text = "".join(accumulated)
+            final_text = accumulated.getvalue()
             session.add_message("assistant", final_text)
-            logger.info(f"Streamed response for session {session_id} with {len(accumulated)} chunks")
+            session.remember_reply(user_message, system_prompt, final_text)
+            await self.asave_session(session)
+            logger.info("Streamed response for session %s with %d chunks", session_id, chunk_count)
         else:
             # If we fall through the loop without success
             error_msg = f"All models exhausted for streaming. Last error: {str(last_exception)}"
@@ -583,13 +1059,13 @@ class BaseLLMModel:
         attachments: Optional[List[types.File]] = None,
     ) -> AsyncIterator[str]:
         """
-        Stream a response with additional prefixed context; saves final answer to history on completion.
+        Stream a response with additional context; saves final answer to history on completion.
+        Context is appended to the system instruction so the user turn stays last.
         """
-        message_with_context = f"{context}\n\nUser Question: {user_message}"
         async for chunk in self.generate_response_stream(
             session_id=session_id,
-            user_message=message_with_context,
-            system_prompt=system_prompt,
+            user_message=user_message,
+            system_prompt=_join_system_context(system_prompt, context),
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
@@ -611,60 +1087,50 @@ class BaseLLMModel:
         temperature: float = 0.0,
         attachments: Optional[List[types.File]] = None,
         response_mime_type: Optional[str] = None,
+        cached_content: Optional[str] = None,
+        response_schema: Optional[type] = None,
     ) -> str:
         """
         Generate a one-off response without session history.
         Useful for internal tasks like classification or summarization.
         Includes cascading fallback support (Flash -> Lite).
+
+        `cached_content` (from get_prompt_cache) replaces `system_prompt` on the primary model;
+        fallback models, which the cache doesn't belong to, still get the prompt inline.
+        `response_schema` (a Pydantic model, with response_mime_type="application/json")
+        has the server enforce the output shape.
         """
         
-        # 1. Build Content Parts (Files + Text)
-        message_parts = []
-        
-        # Add Attachments first if they exist
-        if attachments:
-            for file_ref in attachments:
-                message_parts.append(
-                    types.Part.from_uri(
-                        file_uri=file_ref.uri,
-                        mime_type=file_ref.mime_type
-                    )
-                )
-        
-        # Add the text prompt
-        message_parts.append(types.Part.from_text(text=prompt))
-        
-        contents = [types.Content(role="user", parts=message_parts)]
-
-        # 2. Prepare Config
-        config_params = {
-            "temperature": temperature,
-            "max_output_tokens": max_output_tokens,
-            "top_p": 0.95,
-            "top_k": 40,
-            # "thinking_config": types.ThinkingConfig(thinking_budget=0), 
-        }
-        
-        if system_prompt:
-            config_params["system_instruction"] = system_prompt
+        # 1. Build Contents (files first, then text; a bare string when there are no files)
+        contents = _stateless_contents(prompt, attachments)
 
-        if response_mime_type:
-            config_params["response_mime_type"] = response_mime_type
+        # 2. Prepare Config (memoised on the parameter tuple)
+        generation_config = _build_stateless_config(
+            temperature, max_output_tokens, system_prompt, response_mime_type, None, response_schema
+        )
 
-        generation_config = types.GenerateContentConfig(**config_params)
+        attempts = [(model, generation_config) for model in self.fallback_chain]
+        if cached_content:
+            cached_config = _build_stateless_config(
+                temperature, max_output_tokens, None, response_mime_type, cached_content, response_schema
+            )
+            attempts[0] = (self.fallback_chain[0], cached_config)
         
         # 3. Cascade Loop
         last_exception = None
+        i = 0
         
-        for model in self.fallback_chain:
+        while i < len(attempts):
+            model, config = attempts[i]
+            i += 1
             try:
-                logger.info(f"Attempting stateless generation with model: {model}")
+                logger.info("Attempting stateless generation with model: %s", model)
                 
                 # Call Model (Stateless)
                 response = await self.client.aio.models.generate_content(
                     model=model,
                     contents=contents,
-                    config=generation_config,
+                    config=config,
                 )
                 
                 return response.text if response.text else ""
@@ -675,6 +1141,13 @@ class BaseLLMModel:
                     logger.warning(f"Stateless rate limit hit on {model} (Status: {e.code}). Falling back...")
                     last_exception = e
                     continue # Try next model
+                elif cached_content and config is not generation_config:
+                    # Cache expired/evicted server-side: forget it and retry this model with the prompt inline
+                    logger.warning(f"Cached content {cached_content} rejected on {model}: {e}. Retrying inline...")
+                    self._forget_prompt_cache(cached_content)
+                    attempts.insert(i, (model, generation_config))
+                    last_exception = e
+                    continue
                 else:
                     # Non-retriable error
                     logger.error(f"Stateless non-retriable error on {model}: {e}")
@@ -689,4 +1162,82 @@ class BaseLLMModel:
         # If we fall through the loop without success
         error_msg = f"All models exhausted for stateless generation. Last error: {str(last_exception)}"
         logger.error(error_msg)
-        raise RuntimeError(error_msg)
\ No newline at end of file
+        raise RuntimeError(error_msg)
+    # Streaming variant of generate_stateless_response, for long structured outputs the caller
+    # can start consuming (e.g. parsing quiz questions) before generation finishes
+    async def generate_stateless_response_stream(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        max_output_tokens: int = 100,
+        temperature: float = 0.0,
+        attachments: Optional[List[types.File]] = None,
+        response_mime_type: Optional[str] = None,
+        cached_content: Optional[str] = None,
+        response_schema: Optional[type] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Stream a one-off response without session history.
+        Falls back to the next model only if nothing has been yielded yet.
+        """
+        contents = _stateless_contents(prompt, attachments)
+
+        generation_config = _build_stateless_config(
+            temperature, max_output_tokens, system_prompt, response_mime_type, None, response_schema
+        )
+
+        attempts = [(model, generation_config) for model in self.fallback_chain]
+        if cached_content:
+            cached_config = _build_stateless_config(
+                temperature, max_output_tokens, None, response_mime_type, cached_content, response_schema
+            )
+            attempts[0] = (self.fallback_chain[0], cached_config)
+
+        last_exception = None
+        i = 0
+
+        while i < len(attempts):
+            model, config = attempts[i]
+            i += 1
+            has_yielded_content = False
+            try:
+                logger.info("Attempting stateless stream with model: %s", model)
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=config,
+                )
+                async for delta in _iter_text(stream):
+                    has_yielded_content = True
+                    yield delta
+                return
+
+            except (ClientError, ServerError) as e:
+                if has_yielded_content:
+                    logger.error(f"Error mid-stream on {model}. Cannot fallback.")
+                    raise e
+                if e.code in [429, 503]:
+                    logger.warning(f"Stateless stream rate limit hit on {model} (Status: {e.code}). Falling back...")
+                    last_exception = e
+                    continue
+                elif cached_content and config is not generation_config:
+                    logger.warning(f"Cached content {cached_content} rejected on {model}: {e}. Retrying inline...")
+                    self._forget_prompt_cache(cached_content)
+                    attempts.insert(i, (model, generation_config))
+                    last_exception = e
+                    continue
+                else:
+                    logger.error(f"Stateless stream non-retriable error on {model}: {e}")
+                    raise e
+
+            except Exception as e:
+                if has_yielded_content:
+                    logger.error(f"Error mid-stream on {model}: {e}")
+                    raise e
+                logger.error(f"Stateless stream unexpected error on {model}: {e}")
+                last_exception = e
+                continue
+
+        error_msg = f"All models exhausted for stateless streaming. Last error: {str(last_exception)}"
+        logger.error(error_msg)
+        raise RuntimeError(error_msg)
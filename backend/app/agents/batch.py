@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Generic, Iterable, List, Optional, Set, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class _TokenBucket:
+    """Async token bucket: allows short bursts up to `capacity`, then `rate_per_minute` steady state."""
+
+    def __init__(self, rate_per_minute: int, capacity: int):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class LLMBatcher:
+    """
+    Shared gate for outbound LLM calls.
+
+    Keeps a steady window of at most `max_concurrency` requests in flight and
+    spaces new requests to stay under the provider's requests-per-minute quota,
+    so bursts (e.g. a whole class finishing a quiz) overlap on the network
+    instead of queueing behind each other or tripping 429s.
+
+    Calls flagged `long_output` (expected to generate a lot, so they hold a slot
+    for a long time) may only take `long_output_share` of the slots, which keeps
+    short answers from queueing behind a window full of long ones.
+    """
+
+    def __init__(self, max_concurrency: int = 10, rpm: int = 600, long_output_share: float = 0.5):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._long_output_slots = asyncio.Semaphore(max(1, int(max_concurrency * long_output_share)))
+        self._limiter = _TokenBucket(rpm, capacity=max_concurrency)
+
+    @asynccontextmanager
+    async def _slot(self, long_output: bool) -> AsyncIterator[None]:
+        # Long calls wait for their own lane first, so they never sit on a shared slot while queued
+        if long_output:
+            await self._long_output_slots.acquire()
+        try:
+            async with self._semaphore:
+                await self._limiter.acquire()
+                yield
+        finally:
+            if long_output:
+                self._long_output_slots.release()
+
+    async def submit(self, coro: Awaitable[T], long_output: bool = False) -> T:
+        """Run a single LLM coroutine once a concurrency slot and rate token are available."""
+        async with self._slot(long_output):
+            return await coro
+
+    async def stream(self, agen: AsyncIterator[T], long_output: bool = False) -> AsyncIterator[T]:
+        """
+        Relay a streaming LLM call under the shared window. The slot is held until the
+        stream finishes (or the consumer stops), so concurrent streams count against the
+        same concurrency limit as one-shot calls.
+        """
+        async with self._slot(long_output):
+            try:
+                async for item in agen:
+                    yield item
+            finally:
+                await agen.aclose()
+
+    async def run_batch(self, coros: Iterable[Awaitable[Any]], return_exceptions: bool = True) -> List[Any]:
+        """Fan out many LLM coroutines (e.g. bulk regrading) under the shared window."""
+        return await asyncio.gather(
+            *(self.submit(c) for c in coros),
+            return_exceptions=return_exceptions
+        )
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Coalesces single-item calls from concurrent coroutines into one batched call.
+
+    Items submitted within `max_wait` seconds of the first pending one (or until
+    `max_batch` are waiting) are passed together to `batch_fn`, which must return
+    one result per item in the same order. Each caller gets its own result back.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[T]], Awaitable[List[R]]],
+        max_batch: int = 16,
+        max_wait: float = 0.01
+    ):
+        self._batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending: List[Tuple[T, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Strong refs so in-flight batches aren't garbage collected mid-run
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, item: T) -> R:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[T, asyncio.Future]]) -> None:
+        try:
+            results = await self._batch_fn([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"batch_fn returned {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+# Shared across agents so the window applies to the whole process. Streams hold a slot for
+# their whole duration, so busy deployments may want this closer to GEMINI_HTTP_POOL_SIZE.
+llm_batcher = LLMBatcher(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "10")),
+    rpm=int(os.getenv("LLM_RPM", "600"))
+)
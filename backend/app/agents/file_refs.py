@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import mimetypes
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Tuple
+
+from google.genai import types
+
+from .base_llm_model import BaseLLMModel
+from ..models.document_embedding import Document
+
+logger = logging.getLogger(__name__)
+
+# Gemini deletes uploaded files after 48h; stop reusing a handle a little before that
+GEMINI_FILE_TTL = timedelta(hours=48)
+GEMINI_FILE_EXPIRY_MARGIN = timedelta(hours=1)
+
+# (document id, content sha256) -> (file handle, expires_at). Backs up the Document columns
+# when a handle couldn't be persisted (e.g. a failed commit) and is keyed on content so a
+# replaced file is never served from a stale upload.
+_FILE_REF_CACHE_SIZE = 256
+_file_ref_cache: "OrderedDict[Tuple[int, str], Tuple[types.File, datetime]]" = OrderedDict()
+
+
+# Extensions we actually store, resolved with one dict lookup
+_EXT_TO_MIME = {
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".doc": "application/msword",
+    ".txt": "text/plain",
+    ".md": "text/markdown",
+    ".csv": "text/csv",
+    ".html": "text/html",
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+}
+
+
+@lru_cache(maxsize=512)
+def _guess_mime_type(ext: str) -> str:
+    mime, _ = mimetypes.guess_type(f"file{ext}")
+    return mime or "text/plain"
+
+
+def get_mime_type(filename: str) -> str:
+    """Mime type for a stored document, from its extension."""
+    ext = os.path.splitext(filename)[1].lower()
+    mime = _EXT_TO_MIME.get(ext)
+    if mime is not None:
+        return mime
+    return _guess_mime_type(ext) if ext else "text/plain"
+
+
+def _content_key(doc: Document) -> Tuple[int, str]:
+    return doc.id, hashlib.sha256(doc.file_data).hexdigest()
+
+
+async def resolve_document_file_ref(
+    base_llm: BaseLLMModel,
+    doc: Document,
+    mime_type: str,
+    force: bool = False
+) -> types.File:
+    """
+    Return a Gemini file handle for `doc`, reusing a live one when possible:
+    1. The handle persisted on the Document row
+    2. The in-process LRU keyed on (id, content hash)
+    3. A fresh upload (recorded in both places)
+    The caller is responsible for committing the Document changes.
+    """
+    now = datetime.now(timezone.utc)
+
+    if not force and doc.gemini_file_uri and doc.gemini_file_expires_at and doc.gemini_file_expires_at > now:
+        return types.File(uri=doc.gemini_file_uri, mime_type=mime_type)
+
+    key = _content_key(doc)
+    cached = _file_ref_cache.get(key)
+    if not force and cached is not None and cached[1] > now:
+        _file_ref_cache.move_to_end(key)
+        file_ref, expires_at = cached
+    else:
+        file_ref = await base_llm.aupload_file_from_bytes(doc.file_data, mime_type, doc.filename)
+        expires_at = (file_ref.expiration_time or (now + GEMINI_FILE_TTL)) - GEMINI_FILE_EXPIRY_MARGIN
+        _file_ref_cache[key] = (file_ref, expires_at)
+        _file_ref_cache.move_to_end(key)
+        while len(_file_ref_cache) > _FILE_REF_CACHE_SIZE:
+            _file_ref_cache.popitem(last=False)
+
+    doc.gemini_file_uri = file_ref.uri
+    doc.gemini_file_expires_at = expires_at
+    return file_ref
+
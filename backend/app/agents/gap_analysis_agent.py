@@ -1,11 +1,15 @@
+import asyncio
 import logging
-import json
-import mimetypes
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from google.genai import types
 from .base_llm_model import BaseLLMModel
-from sqlalchemy.orm import Session
+from .batch import llm_batcher
+from .file_refs import get_mime_type, resolve_document_file_ref
+from sqlalchemy.orm import Session, defer
 from ..models.document_embedding import Document
 from ..models.quiz import Quiz, QuizAttempt
+from ..services.embedding_service import embedding_service
+from ..services.semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
@@ -42,16 +46,112 @@ Return a strictly formatted Markdown report. Do NOT use code blocks for the whol
 TONE: Friendly, warm, encouraging, conversational, and detailed. ALWAYS address the user directly as "you". 
 """
 
+GAP_ANALYSIS_USER_PROMPT = """Please generate a friendly Gap Analysis Report addressed directly to the student.
+
+**Quiz Context**:
+- Topic: {title}
+- Source Material: {sources}
+- Score: {score}/{total}
+
+**Mistakes You Made**:
+{mistakes}
+
+Generate the study notes and analysis now, remembering to address the student as "you".
+"""
+
+PERFECT_SCORE_REPORT = "# Perfect Score! 🎉\n\nYou demonstrated excellent mastery of this topic. No knowledge gaps were detected based on this quiz. Keep up the great work!"
+
+EMPTY_QUIZ_REPORT = "# No Questions to Analyse\n\nThis quiz doesn't contain any questions yet, so there is nothing to review. Try another quiz to get a gap analysis!"
+
+# Used when the stored explanations already say everything the LLM would
+DIRECT_REPORT_TEMPLATE = """# 📊 Performance Analysis
+
+## 1. Executive Summary
+You scored {score}/{total} on **{title}**. Nice work overall! You only missed {missed_text}, so your understanding of this topic is solid, with {gap_text} to tighten up.
+
+## 2. 🧠 Detailed Knowledge Gaps
+{gaps}
+## 3. 🎯 Recommended Focus
+Re-read the explanation{plural} above and try the question{plural} again in your own words. Once {it_they} click{s}, you're in great shape for this topic!
+"""
+
+DIRECT_GAP_TEMPLATE = """
+### • {question}
+**Your Answer:** {user_answer}
+**The Correct Answer:** {correct_answer}
+**Why:** {explanation}
+"""
+
+# Students who make the same (or near-identical) mistakes on a quiz get the same report,
+# so finished reports are cached and reused instead of regenerated by the LLM.
+_analysis_cache = SemanticCache(similarity_threshold=0.92, ttl_seconds=24 * 3600)
+
+
 class GapAnalysisAgent:
     def __init__(self, base_llm: BaseLLMModel):
         self.base_llm = base_llm
 
     def _get_mime_type(self, filename: str) -> str:
-        mime, _ = mimetypes.guess_type(filename)
-        if mime: return mime
-        if filename.endswith(".pdf"): return "application/pdf"
-        if filename.endswith(".docx"): return "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        return "text/plain"
+        return get_mime_type(filename)
+
+    async def _resolve_file_ref(self, doc: Document) -> types.File:
+        """Reuse the document's cached Gemini file handle, uploading (and recording) a new one only when expired."""
+        return await resolve_document_file_ref(self.base_llm, doc, self._get_mime_type(doc.filename))
+
+    def _direct_report(self, quiz: Quiz, attempt: QuizAttempt, wrong_answers: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Return a templated report for cases simple enough not to need the LLM, else None.
+        A handful of misses that each already have a stored explanation render directly.
+        """
+        if not quiz.questions:
+            return EMPTY_QUIZ_REPORT
+        if not wrong_answers:
+            return PERFECT_SCORE_REPORT
+
+        if not all(w["explanation"] for w in wrong_answers):
+            return None
+        if len(wrong_answers) > 1 and (quiz.document_ids or len(wrong_answers) >= 3):
+            return None
+
+        single = len(wrong_answers) == 1
+        gaps = "".join(
+            DIRECT_GAP_TEMPLATE.format(
+                question=w["question"],
+                user_answer=w["user_answer"] if w["user_answer"] is not None else "(no answer)",
+                correct_answer=w["correct_answer"],
+                explanation=w["explanation"]
+            )
+            for w in wrong_answers
+        )
+        return DIRECT_REPORT_TEMPLATE.format(
+            score=attempt.score,
+            total=attempt.total_questions,
+            title=quiz.title,
+            missed_text="one question" if single else f"{len(wrong_answers)} questions",
+            gap_text="just one concept" if single else "a couple of concepts",
+            gaps=gaps,
+            plural="" if single else "s",
+            it_they="it" if single else "they",
+            s="s" if single else ""
+        )
+
+    @staticmethod
+    def _format_mistakes(wrong_answers: List[Dict[str, Any]]) -> str:
+        """One terse line per mistake; far fewer prompt tokens than pretty-printed JSON."""
+        lines = []
+        for i, w in enumerate(wrong_answers, start=1):
+            line = f"Q{i}: {w['question']} | your answer: {w['user_answer']} | correct: {w['correct_answer']}"
+            if w["explanation"]:
+                line += f" | explanation: {w['explanation']}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        try:
+            return await embedding_service.aembed_text(text)
+        except Exception as e:
+            logger.warning(f"Skipping semantic cache lookup for gap analysis: {e}")
+            return None
 
     async def generate_analysis(
         self,
@@ -60,14 +160,16 @@ class GapAnalysisAgent:
         db: Session
     ) -> str:
         
-        # 1. Identify Wrong Answers
+        # 1. Identify Wrong Answers (answers normalised to strings once, then a single pass)
+        questions = quiz.questions or []
+        given = {str(k): str(v) for k, v in (attempt.answers or {}).items() if v is not None}
+
+        wrong_indices = []
         wrong_answers = []
-        questions = quiz.questions
-        user_answers = attempt.answers
-        
         for idx, q in enumerate(questions):
-            u_ans = user_answers.get(str(idx)) or user_answers.get(idx)
-            if str(u_ans) != str(q['correct_answer']):
+            u_ans = given.get(str(idx))
+            if u_ans != str(q['correct_answer']):
+                wrong_indices.append(idx)
                 wrong_answers.append({
                     "question": q['question'],
                     "user_answer": u_ans,
@@ -75,54 +177,90 @@ class GapAnalysisAgent:
                     "explanation": q.get('explanation', '')
                 })
 
-        # If they got everything right, give a different prompt
-        if not wrong_answers:
-            return "# Perfect Score! 🎉\n\nYou demonstrated excellent mastery of this topic. No knowledge gaps were detected based on this quiz. Keep up the great work!"
+        # Trivial cases (perfect score, empty quiz, a few already-explained misses) skip the LLM entirely
+        direct_report = self._direct_report(quiz, attempt, wrong_answers)
+        if direct_report is not None:
+            return direct_report
+
+        # 2. Check the report cache (exact mistakes first, then semantically similar ones)
+        # The report quotes the score and the missed questions, so reports are only shared
+        # (semantically) between attempts that missed exactly the same questions with the same score
+        cache_scope = SemanticCache.make_key({
+            "quiz_id": quiz.id,
+            "wrong_indices": wrong_indices,
+            "score": attempt.score,
+            "total": attempt.total_questions,
+            "doc_ids": sorted(quiz.document_ids or []),
+        })
+        cache_key = SemanticCache.make_key({"scope": cache_scope, "wrong": wrong_answers})
+        cached_report = _analysis_cache.get(cache_key)
+        if cached_report is not None:
+            logger.info("Gap analysis cache hit (exact) for quiz %s", quiz.id)
+            return cached_report
 
-        # 2. Fetch Source Documents (if any)
+        mistakes_text = self._format_mistakes(wrong_answers)
+        query_embedding = await self._embed(mistakes_text + quiz.title)
+        if query_embedding is not None:
+            cached_report = _analysis_cache.get_similar(query_embedding, scope=cache_scope)
+            if cached_report is not None:
+                logger.info("Gap analysis cache hit (semantic) for quiz %s", quiz.id)
+                return cached_report
+
+        # 3. Fetch Source Documents (if any)
         uploaded_files = []
         doc_names = []
         
         # Note: This relies on the new `document_ids` column in Quiz model
         if quiz.document_ids:
-            docs = db.query(Document).filter(Document.id.in_(quiz.document_ids)).all()
-            for doc in docs:
-                if doc.file_data:
-                    mime = self._get_mime_type(doc.filename)
-                    try:
-                        file_ref = self.base_llm.upload_file_from_bytes(
-                            doc.file_data, mime, doc.filename
-                        )
-                        uploaded_files.append(file_ref)
-                        doc_names.append(doc.filename)
-                    except Exception as e:
-                        logger.error(f"Error uploading doc for analysis: {e}")
-
-        # 3. Construct the Prompt
-        mistakes_text = json.dumps(wrong_answers, indent=2)
+            # file_data is only loaded for documents without a live Gemini handle
+            docs = db.query(Document).options(defer(Document.file_data)).filter(
+                Document.id.in_(quiz.document_ids),
+                Document.file_data.isnot(None)
+            ).all()
+
+            # Cached handles resolve instantly; any uploads that are needed run concurrently
+            results = await asyncio.gather(
+                *(self._resolve_file_ref(doc) for doc in docs), return_exceptions=True
+            )
+            for doc, result in zip(docs, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error uploading doc for analysis: {result}")
+                    continue
+                uploaded_files.append(result)
+                doc_names.append(doc.filename)
+
+            try:
+                db.commit()
+            except Exception as e:
+                logger.warning(f"Could not persist Gemini file handles: {e}")
+                db.rollback()
+
+        # 4. Construct the Prompt
         doc_context_str = ", ".join(doc_names) if doc_names else "general knowledge (no docs attached)"
 
-        prompt = f"""
-        Please generate a friendly Gap Analysis Report addressed directly to the student.
-        
-        **Quiz Context**:
-        - Topic: {quiz.title}
-        - Source Material: {doc_context_str}
-        - Score: {attempt.score}/{attempt.total_questions}
-        
-        **Mistakes You Made**:
-        {mistakes_text}
-        
-        Generate the study notes and analysis now, remembering to address the student as "you".
-        """
+        prompt = GAP_ANALYSIS_USER_PROMPT.format(
+            title=quiz.title,
+            sources=doc_context_str,
+            score=attempt.score,
+            total=attempt.total_questions,
+            mistakes=mistakes_text
+        )
 
-        # 4. Call LLM
-        response = await self.base_llm.generate_stateless_response(
-            prompt=prompt,
-            system_prompt=GAP_ANALYSIS_SYSTEM_PROMPT,
-            max_output_tokens=4000,
-            temperature=0.5,
-            attachments=uploaded_files
+        # 5. Call LLM (through the shared batcher so concurrent analyses overlap without tripping rate limits)
+        # The static system prompt is served from Gemini's explicit context cache when available
+        prompt_cache = await self.base_llm.get_prompt_cache(GAP_ANALYSIS_SYSTEM_PROMPT)
+        response = await llm_batcher.submit(
+            self.base_llm.generate_stateless_response(
+                prompt=prompt,
+                system_prompt=GAP_ANALYSIS_SYSTEM_PROMPT,
+                max_output_tokens=4000,
+                temperature=0.5,
+                attachments=uploaded_files,
+                cached_content=prompt_cache
+            )
         )
 
+        if response:
+            _analysis_cache.set(cache_key, response, embedding=query_embedding, scope=cache_scope)
+
         return response
\ No newline at end of file
@@ -1,10 +1,15 @@
+import asyncio
+import copy
 import logging
-import json
-import mimetypes
+import orjson
 from typing import List, Optional
 from .base_llm_model import BaseLLMModel
-from sqlalchemy.orm import Session
+from .file_refs import get_mime_type, resolve_document_file_ref
+from sqlalchemy.orm import Session, defer
 from ..models.document_embedding import Document 
+from ..schemas.quiz import GeneratedQuiz
+from ..services.embedding_service import embedding_service
+from ..services.semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
@@ -40,18 +45,35 @@ Do not include markdown formatting (like ```json) in the response, just the raw
 }
 """
 
+# Near-duplicate quiz requests (same documents and length, similar topic) reuse a generated quiz
+_quiz_cache = SemanticCache(similarity_threshold=0.9, ttl_seconds=7 * 24 * 3600)
+
+QUIZ_USER_PROMPT = """Generate a quiz with {num_questions} multiple choice questions.
+
+User Topic/Focus: {topic}
+
+Context: Use the attached file(s) ({doc_list}) as the source material.
+Ensure questions vary in difficulty (Factual, Conceptual, Applied).
+"""
+
 class QuizGeneratorAgent:
     def __init__(self, base_llm: BaseLLMModel):
         self.base_llm = base_llm
 
     def _get_mime_type(self, filename: str) -> str:
-        mime, _ = mimetypes.guess_type(filename)
-        if mime:
-            return mime
-        # Fallback
-        if filename.endswith(".pdf"): return "application/pdf"
-        if filename.endswith(".docx"): return "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        return "text/plain"
+        return get_mime_type(filename)
+
+    async def _upload_one(self, doc: Document):
+        # Reuses the document's live Gemini handle when there is one, otherwise uploads
+        file_ref = await resolve_document_file_ref(self.base_llm, doc, self._get_mime_type(doc.filename))
+        return file_ref, doc.filename
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        try:
+            return await embedding_service.aembed_text(text)
+        except Exception as e:
+            logger.warning(f"Skipping semantic cache lookup for quiz generation: {e}")
+            return None
 
     async def generate_quiz(
         self, 
@@ -62,61 +84,92 @@ class QuizGeneratorAgent:
         db: Session
     ) -> dict:
         
+        # 0. Check the quiz cache (exact request first, then a semantically similar topic on the same docs)
+        cache_scope = SemanticCache.make_key({"doc_ids": sorted(document_ids or []), "num_questions": num_questions})
+        cache_key = SemanticCache.make_key({"scope": cache_scope, "topic": topic_prompt.strip().lower()})
+        cached_quiz = _quiz_cache.get(cache_key)
+        if cached_quiz is not None:
+            logger.info("Quiz cache hit (exact)")
+        else:
+            query_embedding = await self._embed(topic_prompt)
+            if query_embedding is not None:
+                cached_quiz = _quiz_cache.get_similar(query_embedding, scope=cache_scope)
+                if cached_quiz is not None:
+                    logger.info("Quiz cache hit (semantic)")
+
+        if cached_quiz is not None:
+            return copy.deepcopy(cached_quiz)
+
         uploaded_files = []
         doc_names = []
 
         # 1. Fetch Documents and Upload
         if document_ids:
-            docs = db.query(Document).filter(Document.id.in_(document_ids), Document.status == "COMPLETED").all()
-            
-            for doc in docs:
-                if doc.file_data:
-                    mime_type = self._get_mime_type(doc.filename)
-                    try:
-                        print(f"DEBUG: Uploading {doc.filename} to GenAI...")
-                        file_ref = self.base_llm.upload_file_from_bytes(
-                            file_bytes=doc.file_data,
-                            mime_type=mime_type,
-                            display_name=doc.filename
-                        )
-                        uploaded_files.append(file_ref)
-                        doc_names.append(doc.filename)
-                    except Exception as e:
-                        logger.error(f"Skipping document {doc.filename}: {e}")
+            # file_data is only loaded for documents without a live Gemini handle
+            docs = db.query(Document).options(defer(Document.file_data)).filter(
+                Document.id.in_(document_ids),
+                Document.status == "COMPLETED",
+                Document.file_data.isnot(None)
+            ).all()
+
+            # All uploads run concurrently; gather keeps results in input order
+            results = await asyncio.gather(*(self._upload_one(doc) for doc in docs), return_exceptions=True)
+            for doc, result in zip(docs, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Skipping document {doc.filename}: {result}")
+                    continue
+                file_ref, filename = result
+                uploaded_files.append(file_ref)
+                doc_names.append(filename)
+
+            try:
+                db.commit()
+            except Exception as e:
+                logger.warning(f"Could not persist Gemini file handles: {e}")
+                db.rollback()
 
         # 2. Construct Prompt
         doc_list_str = ", ".join(doc_names) if doc_names else "provided context"
         
-        user_message = f"""
-        Generate a quiz with {num_questions} multiple choice questions.
-        
-        User Topic/Focus: {topic_prompt}
-        
-        Context: Use the attached file(s) ({doc_list_str}) as the source material.
-        Ensure questions vary in difficulty (Factual, Conceptual, Applied).
-        """
+        user_message = QUIZ_USER_PROMPT.format(
+            num_questions=num_questions,
+            topic=topic_prompt,
+            doc_list=doc_list_str
+        )
 
-        print("DEBUG: Calling QUIZ AGENT (Stateless)")
+        logger.debug("Calling quiz agent (stateless)")
         
-        # 3. Call LLM (Using Stateless Method)
-        # Note: We pass max_output_tokens=4000 to ensure we get the full JSON
+        # 3. Call LLM (the response schema has the server enforce the quiz shape)
+        prompt_cache = await self.base_llm.get_prompt_cache(QUIZ_SYSTEM_PROMPT)
         response_text = await self.base_llm.generate_stateless_response(
             prompt=user_message,
             system_prompt=QUIZ_SYSTEM_PROMPT,
             temperature=0.4, 
             max_output_tokens=8192,
             attachments=uploaded_files,
-            response_mime_type="application/json"
+            response_mime_type="application/json",
+            response_schema=GeneratedQuiz,
+            cached_content=prompt_cache
         )
 
         if not response_text:
             raise ValueError("Empty response received from AI Model")
 
-        # 4. Parse JSON
+        # 4. Parse
         try:
             # Because we used application/json, we no longer need to strip markdown ```json block wrappers!
-            quiz_data = json.loads(response_text.strip())
-            return quiz_data
-        except json.JSONDecodeError:
+            quiz_data = orjson.loads(response_text.strip())
+        except orjson.JSONDecodeError:
             logger.error(f"Failed to parse quiz JSON: {response_text}")
-            raise ValueError("Failed to generate valid quiz format. Please try again.")
\ No newline at end of file
+            raise ValueError("Failed to generate valid quiz format. Please try again.")
+
+        questions = quiz_data.get("questions", []) if isinstance(quiz_data, dict) else quiz_data
+
+        # A truncated or short response must not be saved (or cached for a week) as a smaller quiz
+        if len(questions) < num_questions:
+            logger.error(f"Quiz generation returned {len(questions)} of {num_questions} questions")
+            raise ValueError("The generated quiz was incomplete. Please try again.")
+
+        quiz = {"questions": questions}
+        _quiz_cache.set(cache_key, copy.deepcopy(quiz), embedding=query_embedding, scope=cache_scope)
+        return quiz
@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Protocol, Set, Tuple
+
+import msgpack
+
+if TYPE_CHECKING:
+    from .base_llm_model import ChatSession
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(Protocol):
+    """Storage backend for ChatSession objects used by BaseLLMModel."""
+
+    # True when calls do network I/O; async callers then run them off the event loop
+    blocking: bool
+
+    def get(self, session_id: str) -> Optional["ChatSession"]: ...
+
+    def put(self, session: "ChatSession") -> None: ...
+
+    def delete(self, session_id: str) -> bool: ...
+
+    def list(self, group_id: Optional[int] = None) -> List["ChatSession"]: ...
+
+    def evict_idle(self, older_than: timedelta) -> int: ...
+
+
+class InMemorySessionStore:
+    """Process-local LRU of sessions (least recently used evicted at `max_sessions`)."""
+
+    blocking = False
+
+    def __init__(self, max_sessions: int = 100):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        # Secondary index so listing a group's sessions doesn't scan every session
+        self._by_group: Dict[int, Set[str]] = defaultdict(set)
+
+    def _unindex(self, session: "ChatSession") -> None:
+        group_ids = self._by_group.get(session.group_id)
+        if group_ids is not None:
+            group_ids.discard(session.session_id)
+            if not group_ids:
+                del self._by_group[session.group_id]
+
+    def get(self, session_id: str) -> Optional["ChatSession"]:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def put(self, session: "ChatSession") -> None:
+        if session.session_id in self._sessions:
+            self._sessions.move_to_end(session.session_id)
+            self._sessions[session.session_id] = session
+            return
+
+        # At capacity: evict the least recently used session instead of failing the request
+        while len(self._sessions) >= self.max_sessions:
+            evicted_id, evicted = self._sessions.popitem(last=False)
+            self._unindex(evicted)
+            logger.info("Max sessions (%d) reached, evicted LRU session %s", self.max_sessions, evicted_id)
+        self._sessions[session.session_id] = session
+        self._by_group[session.group_id].add(session.session_id)
+
+    def delete(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._unindex(session)
+        return True
+
+    def list(self, group_id: Optional[int] = None) -> List["ChatSession"]:
+        if group_id is None:
+            return list(self._sessions.values())
+        return [self._sessions[sid] for sid in self._by_group.get(group_id, ())]
+
+    def evict_idle(self, older_than: timedelta) -> int:
+        cutoff = time.time() - older_than.total_seconds()
+        idle_ids = [sid for sid, s in self._sessions.items() if s.last_accessed < cutoff]
+        for sid in idle_ids:
+            self._unindex(self._sessions.pop(sid))
+        return len(idle_ids)
+
+
+class RedisSessionStore:
+    """
+    Sessions serialised to Redis under `sess:{id}` so they are shared by all workers
+    instead of duplicated in each process heap. Idle sessions expire via the key TTL.
+
+    A short-lived local cache sits in front so repeated lookups of the same session
+    within one request don't each cost a round-trip.
+
+    The client is synchronous; BaseLLMModel's async session helpers run these calls in a
+    worker thread (hence the lock around the local cache) so they never block the event loop.
+    """
+
+    blocking = True
+
+    KEY_PREFIX = "sess:"
+    GROUP_PREFIX = "sess_group:"
+
+    def __init__(
+        self,
+        redis_url: str,
+        session_factory: Callable[[Dict[str, Any]], "ChatSession"],
+        idle_ttl: timedelta = timedelta(hours=24),
+        local_ttl_seconds: float = 5.0,
+        local_max_entries: int = 1000
+    ):
+        import redis
+
+        self._redis = redis.Redis.from_url(redis_url)
+        self._session_factory = session_factory
+        self._idle_ttl = int(idle_ttl.total_seconds())
+        self._local_ttl = local_ttl_seconds
+        self._local_max = local_max_entries
+        self._local: "OrderedDict[str, Tuple[float, ChatSession]]" = OrderedDict()
+        self._local_lock = threading.Lock()
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.KEY_PREFIX}{session_id}"
+
+    def _remember(self, session: "ChatSession") -> None:
+        with self._local_lock:
+            self._local[session.session_id] = (time.monotonic() + self._local_ttl, session)
+            self._local.move_to_end(session.session_id)
+            while len(self._local) > self._local_max:
+                self._local.popitem(last=False)
+
+    def _forget(self, session_id: str) -> None:
+        with self._local_lock:
+            self._local.pop(session_id, None)
+
+    def _serialize(self, session: "ChatSession") -> bytes:
+        return msgpack.packb(session.to_dict(), use_bin_type=True)
+
+    def _deserialize(self, raw: bytes) -> "ChatSession":
+        return self._session_factory(msgpack.unpackb(raw, raw=False))
+
+    def get(self, session_id: str) -> Optional["ChatSession"]:
+        with self._local_lock:
+            cached = self._local.get(session_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        raw = self._redis.get(self._key(session_id))
+        if raw is None:
+            self._forget(session_id)
+            return None
+
+        session = self._deserialize(raw)
+        self._remember(session)
+        return session
+
+    def put(self, session: "ChatSession") -> None:
+        pipe = self._redis.pipeline()
+        pipe.set(self._key(session.session_id), self._serialize(session), ex=self._idle_ttl)
+        pipe.sadd(f"{self.GROUP_PREFIX}{session.group_id}", session.session_id)
+        pipe.execute()
+        self._remember(session)
+
+    def delete(self, session_id: str) -> bool:
+        self._forget(session_id)
+        return bool(self._redis.delete(self._key(session_id)))
+
+    def list(self, group_id: Optional[int] = None) -> List["ChatSession"]:
+        if group_id is None:
+            keys = list(self._redis.scan_iter(match=f"{self.KEY_PREFIX}*"))
+        else:
+            members = self._redis.smembers(f"{self.GROUP_PREFIX}{group_id}")
+            keys = [self._key(m.decode("utf-8")) for m in members]
+        if not keys:
+            return []
+        return [self._deserialize(raw) for raw in self._redis.mget(keys) if raw is not None]
+
+    def evict_idle(self, older_than: timedelta) -> int:
+        # Redis expires idle sessions through the key TTL; only the local cache needs sweeping
+        now = time.monotonic()
+        with self._local_lock:
+            stale = [sid for sid, (expires_at, _) in self._local.items() if expires_at <= now]
+            for sid in stale:
+                del self._local[sid]
+        return 0
@@ -1,11 +1,14 @@
 import logging
-from typing import List, Dict, Any
+from collections import OrderedDict
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
 from .base_llm_model import BaseLLMModel
+from .batch import llm_batcher
+from ..services.semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
-SUMMARY_SYSTEM_PROMPT = """You are a helpful study assistant. 
-A student has returned to the chat after being away. 
+SUMMARY_SYSTEM_PROMPT = """You are a helpful study assistant.
+A student has returned to the chat after being away.
 Summarise the missed conversation for them.
 
 Focus on:
@@ -13,42 +16,155 @@ Focus on:
 2. Specific questions asked to the Teaching AI.
 3. Important decisions or conclusions made by the group.
 
-Format the output as a concise bulleted list or a short paragraph. 
+Format the output as a concise bulleted list or a short paragraph.
 Do NOT list every single message. Synthesize the information.
 """
 
+SUMMARY_USER_PROMPT = """Here is the conversation log:
+
+{conversation}
+
+Please provide a summary for the returning student.
+"""
+
+# Extends an earlier summary of the same backlog with only the messages sent since
+INCREMENTAL_SUMMARY_USER_PROMPT = """Here is the summary of the conversation so far:
+
+{previous_summary}
+
+New messages since that summary:
+
+{conversation}
+
+Update the summary so it also covers the new messages. Return the full updated summary for the returning student.
+"""
+
+# Members returning to the same backlog get the same summary without another LLM call
+_summary_cache = SemanticCache(ttl_seconds=1800, max_entries=256)
+
+_INCREMENTAL_STATE_SIZE = 256
+
+# Most raw messages sent in one prompt; anything older is folded into a running summary
+SUMMARY_WINDOW_MESSAGES = 100
+
 class SummarisingAgent:
-    def __init__(self, base_llm: BaseLLMModel):
+    def __init__(self, base_llm: BaseLLMModel, window_messages: int = SUMMARY_WINDOW_MESSAGES):
         self.base_llm = base_llm
+        self.window_messages = window_messages
+        # (group_id, first message id) -> (summary, id of the last message it covers)
+        self._last_summary: "OrderedDict[Tuple[int, Any], Tuple[str, Any]]" = OrderedDict()
+
+    @staticmethod
+    def _format_prompt(previous_summary: Optional[str], lines: List[str]) -> str:
+        if previous_summary is None:
+            return SUMMARY_USER_PROMPT.format(conversation="\n".join(lines))
+        return INCREMENTAL_SUMMARY_USER_PROMPT.format(
+            previous_summary=previous_summary,
+            conversation="\n".join(lines)
+        )
+
+    async def _fold(self, previous_summary: Optional[str], lines: List[str]) -> str:
+        """Summarise one window of older messages on top of the running summary."""
+        return await llm_batcher.submit(self.base_llm.generate_stateless_response(
+            prompt=self._format_prompt(previous_summary, lines),
+            system_prompt=SUMMARY_SYSTEM_PROMPT,
+            max_output_tokens=1000,
+            temperature=0.3
+        ))
 
-    async def summarise_chat(self, messages: List[Dict[str, Any]]) -> str:
+    async def _build_prompt(
+        self,
+        messages: List[Dict[str, Any]],
+        lines: List[str],
+        state_key: Optional[Tuple[int, Any]]
+    ) -> str:
+        """
+        Prompt with at most `window_messages` raw messages, on top of a running summary of
+        anything older. The running summary is the previous summary of this backlog when
+        there is one; messages older than the window are folded into it one window at a time.
+        """
+        previous_summary = None
+        start = 0
+        previous = self._last_summary.get(state_key) if state_key is not None else None
+        if previous is not None:
+            summary, last_id = previous
+            for idx, msg in enumerate(messages):
+                if msg.get("id") == last_id:
+                    if idx + 1 < len(lines):
+                        previous_summary, start = summary, idx + 1
+                        logger.info(f"Extending previous summary with {len(lines) - start} new messages")
+                    break
+
+        # 1. Fold everything older than the window into the running summary
+        tail_start = max(start, len(lines) - self.window_messages)
+        for chunk_start in range(start, tail_start, self.window_messages):
+            chunk_end = min(chunk_start + self.window_messages, tail_start)
+            previous_summary = await self._fold(previous_summary, lines[chunk_start:chunk_end])
+            self._remember(state_key, previous_summary, messages[chunk_end - 1].get("id"))
+
+        # 2. The newest window goes in verbatim
+        return self._format_prompt(previous_summary, lines[tail_start:])
+
+    def _remember(self, state_key: Optional[Tuple[int, Any]], summary: str, last_id: Any) -> None:
+        if state_key is None or last_id is None:
+            return
+        self._last_summary[state_key] = (summary, last_id)
+        self._last_summary.move_to_end(state_key)
+        while len(self._last_summary) > _INCREMENTAL_STATE_SIZE:
+            self._last_summary.popitem(last=False)
+
+    async def summarise_chat_stream(
+        self,
+        messages: List[Dict[str, Any]],
+        group_id: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """
+        Stream the summary as it is generated.
+
+        When messages carry an "id" and a group_id is given, the previous summary of the
+        same backlog (same first message) is reused and only the newer messages are sent.
+        At most `window_messages` messages go into the prompt verbatim; older ones are
+        summarised first, so the prompt size doesn't grow with the backlog.
+        """
         if not messages:
-            return "No messages to summarise."
+            yield "No messages to summarise."
+            return
 
         # Format messages for the LLM
         # e.g. "User1: Hello", "AI: Hi there"
-        conversation_text = ""
-        for msg in messages:
-            sender = msg.get("username", "Unknown")
-            content = msg.get("content", "")
-            conversation_text += f"{sender}: {content}\n"
-
-        prompt = f"""
-        Here is the conversation log:
-        
-        {conversation_text}
-        
-        Please provide a summary for the returning student.
-        """
+        lines = [f"{msg.get('username', 'Unknown')}: {msg.get('content', '')}" for msg in messages]
+
+        cache_key = SemanticCache.make_key(lines)
+        cached_summary = _summary_cache.get(cache_key)
+        if cached_summary is not None:
+            logger.info("Summary cache hit")
+            yield cached_summary
+            return
 
+        first_id = messages[0].get("id")
+        state_key = (group_id, first_id) if group_id is not None and first_id is not None else None
+
+        chunks: List[str] = []
         try:
-            response = await self.base_llm.generate_stateless_response(
+            prompt = await self._build_prompt(messages, lines, state_key)
+            async for delta in llm_batcher.stream(self.base_llm.generate_stateless_response_stream(
                 prompt=prompt,
                 system_prompt=SUMMARY_SYSTEM_PROMPT,
                 max_output_tokens=1000,
                 temperature=0.3
-            )
-            return response
+            )):
+                chunks.append(delta)
+                yield delta
         except Exception as e:
             logger.error(f"Error summarising chat: {e}")
-            return "Failed to generate summary."
\ No newline at end of file
+            if not chunks:
+                yield "Failed to generate summary."
+            return
+
+        summary = "".join(chunks)
+        if summary:
+            _summary_cache.set(cache_key, summary)
+            self._remember(state_key, summary, messages[-1].get("id"))
+
+    async def summarise_chat(self, messages: List[Dict[str, Any]], group_id: Optional[int] = None) -> str:
+        return "".join([delta async for delta in self.summarise_chat_stream(messages, group_id)])
@@ -4,19 +4,32 @@ Uses Socratic prompting to enhance learning and critical thinking.
 Integrates with RAG system for document and conversation context.
 """
 
-from typing import Optional, Dict, Any, List, Iterator, AsyncIterator
+from typing import Optional, Dict, Any, List, AsyncIterator, Tuple
 from enum import Enum
 from dataclasses import dataclass
+import asyncio
 import logging
 import re
+from functools import lru_cache
 
 from .base_llm_model import BaseLLMModel
+from .batch import MicroBatcher, llm_batcher
 from ..services.rag_service import RAGConfig, RAGService
 from ..services.document_service import DocumentService
+from ..services.embedding_service import embedding_service
+from ..services.semantic_cache import SemanticCache
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+__all__ = [
+    "RAGMode",
+    "QuestionDifficulty",
+    "TAConfig",
+    "AnswerRequest",
+    "TeachingAssistantAgent",
+]
+
 
 class RAGMode(Enum):
     """Enum for RAG operating modes."""
@@ -32,7 +45,7 @@ class QuestionDifficulty(Enum):
     APPLIED = "applied"  # Problems: "solve", "code", "math", "reasoning"
     COMPLEX = "complex"  # Multi-step: "compare", "analyze", "design"
 
-@dataclass
+@dataclass(slots=True)
 class TAConfig:
     """Configuration for Teaching Assistant Agent."""
     rag_mode: RAGMode = RAGMode.DOCUMENTS_ONLY
@@ -52,12 +65,25 @@ class TAConfig:
     socratic_prompt_limit_complex: int = 3  # Multi-step -> 2-3 questions to guide thinking
     
     enable_follow_ups: bool = True
+    
+    # Opt-in: retrieve top-1 instead of top-3 chunks, trading context for time to first token
+    low_latency_rag: bool = False
     follow_up_probability: float = 0.2  # 20% chance of follow-up question
     
     # Minimum confidence to provide direct answer
     min_confidence_for_direct_answer: float = 0.7
 
 
+@dataclass(slots=True)
+class AnswerRequest:
+    """One question for TeachingAssistantAgent.answer_many."""
+    session_id: str
+    group_id: int
+    question: str
+    use_rag: bool = True
+    active_config: Optional[TAConfig] = None
+
+
 # ========================
 # System Prompts
 # ========================
@@ -131,6 +157,115 @@ Categorize the user's question into exactly one of these 4 categories:
 
 Return ONLY the category name (e.g., "FACTUAL"). Do not add punctuation or explanation."""
 
+# Same classifier for several questions in one call (concurrent classifications are coalesced)
+BATCH_CLASSIFICATION_SYSTEM_PROMPT = """You are a precise classifier. 
+Categorize EACH numbered question separately into exactly one of these 4 categories:
+1. FACTUAL (Simple facts, definitions, list requests)
+2. CONCEPTUAL (Explanations, 'how'/'why' questions, comparisons)
+3. APPLIED (Coding, math, debugging, solving specific problems)
+4. COMPLEX (Design, analysis, open-ended evaluation)
+
+Return one line per question in the form "<number>: <CATEGORY>" (e.g., "2: FACTUAL"). Do not add explanation."""
+
+_BATCH_CLASSIFICATION_LINE_RE = re.compile(r'^\s*(\d+)\s*[:.)-]\s*([A-Za-z]+)', re.MULTILINE)
+
+
+# Direct Answer mode (low limit or Socratic mode disabled): one fixed string, built at import
+DIRECT_ANSWER_SYSTEM_PROMPT = f"""{ADAPTIVE_SYSTEM_PROMPT}
+
+---
+IMPORTANT INSTRUCTION: DIRECT ANSWER MODE
+For this specific interaction, do NOT use Socratic questioning or guiding questions.
+1. Provide a clear, direct, and complete answer immediately.
+2. Do not ask the student to guess or "try first."
+3. Explain the concept fully in your first response.
+---"""
+
+
+@lru_cache(maxsize=32)
+def _adaptive_system_prompt(prompt_limit: int) -> str:
+    """Adaptive system prompt for a Socratic prompt limit (0 or 1 means direct answer mode)."""
+    # Base prompt
+    base_prompt = ADAPTIVE_SYSTEM_PROMPT
+
+    # Mode 1: Direct Answer (Low limit or Socratic Mode Disabled)
+    if prompt_limit <= 1:
+        return DIRECT_ANSWER_SYSTEM_PROMPT
+
+    # Mode 2: Socratic/Guiding Mode (Limit > 1)
+    else:
+        return f"""{base_prompt}
+
+            ---
+            IMPORTANT INSTRUCTION: SOCRATIC MODE (Limit: {prompt_limit} interactions)
+            You are acting as a guide. Do NOT give the answer immediately.
+            
+            1. Use your chat history to track the conversation depth.
+            2. You are allowed a MAXIMUM of {prompt_limit} guiding questions/hints for this topic.
+            3. If the student is still stuck after {prompt_limit} exchanges, you MUST stop asking questions and provide the full solution/explanation.
+            4. If the student answers correctly, validate them immediately.
+            ---"""
+
+
+def _union(*patterns: str, flags: int = 0) -> "re.Pattern[str]":
+    """One compiled alternation, so a category costs a single search instead of one per pattern."""
+    return re.compile("|".join(f"(?:{p})" for p in patterns), flags)
+
+
+# Difficulty patterns, compiled once. Matched against the lower-cased question text
+# without the "Username: " prefix the chat layer adds. The applied patterns are unanchored,
+# case-insensitive and let `.` span line breaks, so they run on the raw (stripped) text
+# before any lowercased copy is made.
+_APPLIED_RE = _union(
+    r'code\s+', r'write\s+.*\s+function', r'solve\s+', r'calculate\s+',
+    r'implement\s+', r'debug\s+', r'fix\s+', r'algorithm\s+', r'error\s+',
+    flags=re.IGNORECASE | re.DOTALL
+)
+
+# Leading-word prefixes are looked up on the first few tokens rather than regex-scanned.
+# A prefix only counts when more words follow it, as the old `^word\s+` patterns required.
+_COMPLEX_PREFIXES = frozenset({
+    ("analyze",), ("design",), ("evaluate",), ("suggest",), ("hypothesize",),
+    ("how", "would", "you"),
+})
+_FACTUAL_PREFIXES = frozenset({
+    ("what", "is"), ("what", "are"), ("where", "is"), ("when", "did"), ("who", "is"),
+    ("define",), ("list",),
+})
+# What isn't a whole-word prefix stays a regex
+_COMPLEX_RE = _union(r'^what\s+would\s+happen')
+_FACTUAL_RE = _union(r'^which\s+.*\?$', r'is\s+.*\s+the\s+')
+
+
+def _has_prefix(tokens: List[str], prefixes: frozenset) -> bool:
+    return any(tuple(tokens[:n]) in prefixes for n in (1, 2, 3) if len(tokens) > n)
+
+# Unambiguous signals that settle the category without the LLM classifier.
+# Used only when exactly one of them fires; anything else is left to the LLM.
+_DIFFICULTY_PREFILTERS = (
+    (QuestionDifficulty.FACTUAL, re.compile(
+        r'^(what\s+(is|are)|where\s+is|when\s+(did|was)|who\s+(is|was)|define|list)\s+'
+    )),
+    (QuestionDifficulty.CONCEPTUAL, re.compile(r'\b(why|how\s+(does|do|is|are)|explain|difference)\b')),
+    (QuestionDifficulty.COMPLEX, re.compile(r'\b(compare|contrast|analy[sz]e|design|evaluate|trade[- ]?offs?)\b')),
+)
+
+# TAConfig field holding the Socratic prompt limit for each difficulty
+_SOCRATIC_LIMIT_FIELDS: Dict[QuestionDifficulty, str] = {
+    QuestionDifficulty.FACTUAL: "socratic_prompt_limit_factual",
+    QuestionDifficulty.CONCEPTUAL: "socratic_prompt_limit_conceptual",
+    QuestionDifficulty.APPLIED: "socratic_prompt_limit_applied",
+    QuestionDifficulty.COMPLEX: "socratic_prompt_limit_complex",
+}
+
+# Difficulties whose answers run long; they get a capped share of the LLM window
+_LONG_OUTPUT_DIFFICULTIES = frozenset({QuestionDifficulty.COMPLEX})
+
+# LLM classifications, by normalised question text and by question embedding, so a
+# rephrasing of an already-classified question skips the classifier call too.
+# Expires so edits to CLASSIFICATION_SYSTEM_PROMPT take effect within a day.
+_classification_cache = SemanticCache(similarity_threshold=0.95, ttl_seconds=86400, max_entries=4096)
+
 
 FOLLOW_UP_TEMPLATE = """Great question! Before I explain {topic}, what do you already know about it? 
 This will help me pitch my explanation at the right level for you."""
@@ -145,6 +280,46 @@ RAG_CONTEXT_TEMPLATE = """Based on the study materials available, here's relevan
 Using this context, I'll help you understand the concept better."""
 
 
+# Retrieved-materials block (explicit citation prompting). Sent ahead of the per-turn
+# "Student Question" line and byte-identical for the same retrieved chunks, so repeated
+# turns share the longest possible prompt prefix with Gemini's implicit cache.
+RAG_MATERIALS_TEMPLATE = (
+    "SYSTEM: I have automatically retrieved the following study materials for you. "
+    "Please EVALUATE their relevance to the student's question:\n"
+    "1. If the materials contain the answer, you MUST use them and STRICTLY cite the source document name inline (e.g., 'According to [Filename.pdf], ...' or '... as shown in the materials [Filename.pdf]').\n"
+    "2. If the materials are IRRELEVANT (e.g., matched on keywords but wrong topic), "
+    "IGNORE them completely and answer based on your general knowledge.\n"
+    "3. Do NOT force a connection if none exists.\n\n"
+    "--- RETRIEVED MATERIALS ---\n"
+    "{context}\n"
+    "--- END MATERIALS ---"
+)
+# Split once at import so each turn is a plain concatenation rather than a str.format parse
+_RAG_MATERIALS_PREFIX, _, _RAG_MATERIALS_SUFFIX = RAG_MATERIALS_TEMPLATE.partition("{context}")
+# Everything between the retrieved context and the student's message
+_RAG_QUESTION_PREFIX = _RAG_MATERIALS_SUFFIX + "\n\nStudent Question: "
+
+
+# Retrieval settings per (RAG mode, low latency), built once and shared read-only across requests
+_RAG_CONFIGS: Dict[Tuple[RAGMode, bool], RAGConfig] = {
+    (mode, low_latency): RAGConfig(
+        include_documents=mode in (RAGMode.DOCUMENTS_ONLY, RAGMode.BOTH),
+        include_conversations=mode in (RAGMode.CONVERSATIONS_ONLY, RAGMode.BOTH),
+        top_k_documents=1 if low_latency else 3,
+        top_k_conversations=1 if low_latency else 3
+    )
+    for mode in RAGMode
+    for low_latency in (False, True)
+}
+
+
+# Near-duplicate standalone questions in the same group reuse the earlier answer
+_answer_cache = SemanticCache(similarity_threshold=0.95, ttl_seconds=3600, max_entries=1024)
+
+# Shorter messages mid-conversation are treated as follow-ups and never cached
+_STANDALONE_QUESTION_MIN_WORDS = 6
+
+
 # ========================
 # Teaching Assistant Agent
 # ========================
@@ -178,73 +353,178 @@ class TeachingAssistantAgent:
         self.base_llm = base_llm
         self.rag_service = rag_service
         self.default_config = config or TAConfig()
+        # Classifications from concurrent requests share one LLM call
+        self._classification_batcher: MicroBatcher[str, QuestionDifficulty] = MicroBatcher(
+            self._classify_batch, max_batch=16, max_wait=0.01
+        )
         
         logger.info("Initialized TeachingAssistantAgent")
     
 
+    # ========================
+    # Answer Cache
+    # ========================
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        try:
+            return await embedding_service.aembed_text(text)
+        except Exception as e:
+            logger.warning(f"Skipping semantic answer cache lookup: {e}")
+            return None
+
+    async def _lookup_cached_answer(
+        self,
+        session_id: str,
+        group_id: int,
+        question: str,
+        config: TAConfig
+    ) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[List[float]]]:
+        """
+        Find an earlier answer to the same (or a near-identical) standalone question in the group.
+        Short follow-ups in an ongoing conversation ("yes", "tell me more") depend on the
+        history, so they bypass the cache and cache_key comes back as None.
+
+        Returns (cached_answer, cache_key, cache_scope, question_embedding).
+        """
+        text = question.split(": ", 1)[1] if ": " in question else question
+        if await self._is_follow_up(session_id, text):
+            return None, None, None, None
+
+        cache_scope = SemanticCache.make_key({
+            "group_id": group_id,
+            "rag_mode": config.rag_mode.value,
+        })
+        cache_key = SemanticCache.make_key({"scope": cache_scope, "question": " ".join(text.lower().split())})
+
+        cached = _answer_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Answer cache hit (exact) for group %s", group_id)
+            return cached, cache_key, cache_scope, None
+
+        embedding = await self._embed(text)
+        if embedding is not None:
+            cached = _answer_cache.get_similar(embedding, scope=cache_scope)
+            if cached is not None:
+                logger.info("Answer cache hit (semantic) for group %s", group_id)
+        return cached, cache_key, cache_scope, embedding
+
+    async def _is_follow_up(self, session_id: str, text: str) -> bool:
+        """A short message once the session already has a reply is read as a reply to it."""
+        if len(text.split()) >= _STANDALONE_QUESTION_MIN_WORDS:
+            return False
+        session = await self.base_llm.aget_session(session_id)
+        return session is not None and any(msg.role == "assistant" for msg in session.chat_history)
+
+    async def _replay_cached_answer(self, session_id: str, question: str, answer: str) -> None:
+        """Record a cached exchange in the session so the conversation history stays coherent."""
+        await self.base_llm.aadd_message_to_history(session_id, "user", question)
+        await self.base_llm.aadd_message_to_history(session_id, "assistant", answer)
+
     # ========================
     # Question Analysis
     # ========================
 
-    async def _classify_with_llm(self, question: str) -> QuestionDifficulty:
-        """Second-level check using a fast LLM call."""
+    @staticmethod
+    def _parse_category(response: str) -> QuestionDifficulty:
+        category = response.strip().upper()
+        
+        if "FACTUAL" in category: return QuestionDifficulty.FACTUAL
+        if "CONCEPTUAL" in category: return QuestionDifficulty.CONCEPTUAL
+        if "APPLIED" in category: return QuestionDifficulty.APPLIED
+        if "COMPLEX" in category: return QuestionDifficulty.COMPLEX
+        
+        return QuestionDifficulty.CONCEPTUAL # Default fallback
+
+    async def _classify_batch(self, questions: List[str]) -> List[QuestionDifficulty]:
+        """Classify the questions coalesced by the batcher, in one LLM call."""
         try:
+            if len(questions) == 1:
+                response = await self.base_llm.generate_stateless_response(
+                    prompt=f"Question: {questions[0]}",
+                    system_prompt=CLASSIFICATION_SYSTEM_PROMPT,
+                    max_output_tokens=10,
+                    temperature=0.0
+                )
+                return [self._parse_category(response)]
+
             response = await self.base_llm.generate_stateless_response(
-                prompt=f"Question: {question}",
-                system_prompt=CLASSIFICATION_SYSTEM_PROMPT,
-                max_output_tokens=10,
+                prompt="\n".join(f"{i}. Question: {q}" for i, q in enumerate(questions, 1)),
+                system_prompt=BATCH_CLASSIFICATION_SYSTEM_PROMPT,
+                max_output_tokens=10 * len(questions),
                 temperature=0.0
             )
-            
-            category = response.strip().upper()
-            
-            if "FACTUAL" in category: return QuestionDifficulty.FACTUAL
-            if "CONCEPTUAL" in category: return QuestionDifficulty.CONCEPTUAL
-            if "APPLIED" in category: return QuestionDifficulty.APPLIED
-            if "COMPLEX" in category: return QuestionDifficulty.COMPLEX
-            
-            return QuestionDifficulty.CONCEPTUAL # Default fallback
-            
+            # Unanswered or unparseable lines fall back to CONCEPTUAL, like a single call would
+            results = [QuestionDifficulty.CONCEPTUAL] * len(questions)
+            for number, category in _BATCH_CLASSIFICATION_LINE_RE.findall(response):
+                idx = int(number) - 1
+                if 0 <= idx < len(questions):
+                    results[idx] = self._parse_category(category)
+            return results
+
         except Exception as e:
             logger.error(f"LLM classification failed: {e}")
-            return QuestionDifficulty.CONCEPTUAL
+            return [QuestionDifficulty.CONCEPTUAL] * len(questions)
+
+    async def _classify_with_llm(self, question: str) -> QuestionDifficulty:
+        """Second-level check using a fast LLM call (coalesced with concurrent classifications)."""
+        return await self._classification_batcher.submit(question)
 
-    async def _detect_question_difficulty(self, question: str, config: TAConfig) -> QuestionDifficulty:
+    @staticmethod
+    def _difficulty_changes_prompt(config: TAConfig) -> bool:
+        """Whether different difficulties can lead to different adaptive system prompts."""
+        if not config.use_socratic_prompting:
+            return False
+        # Limits of 0 and 1 both mean direct answer mode
+        return len({max(getattr(config, field), 1) for field in _SOCRATIC_LIMIT_FIELDS.values()}) > 1
+
+    async def _detect_question_difficulty(
+        self,
+        question: str,
+        config: TAConfig,
+        question_embedding: Optional[List[float]] = None
+    ) -> QuestionDifficulty:
         """
         Detect question difficulty using Hybrid approach.
+        `question_embedding` (from the answer-cache lookup) enables the semantic classification cache.
         """
-        question_lower = question.lower().strip()
+        # Patterns are anchored on the question itself, not the "Username: " prefix
+        question_text = (question.split(": ", 1)[-1] if ": " in question else question).strip()
         
         # 1. Strong Regex Signals (Keep these as they are fast and usually correct)
-        applied_patterns = [
-            r'code\s+', r'write\s+.*\s+function', r'solve\s+', r'calculate\s+',
-            r'implement\s+', r'debug\s+', r'fix\s+', r'algorithm\s+', r'error\s+'
-        ]
-        for pattern in applied_patterns:
-            if re.search(pattern, question_lower):
-                return QuestionDifficulty.APPLIED
+        if _APPLIED_RE.search(question_text):
+            return QuestionDifficulty.APPLIED
+
+        # Normalised once for the anchored patterns, token prefixes and the classification cache
+        question_lower = " ".join(question_text.lower().split())
         
-        # 2. If config allows, use LLM for the rest
-        # CHANGED: Use passed config instead of self.config
-        if config.use_llm_difficulty_check:
-            return await self._classify_with_llm(question)
+        # 2. If config allows, use LLM for the rest. Skipped when every difficulty ends up with
+        #    the same system prompt (Socratic mode off, or all limits equal): the answer couldn't
+        #    change anything, so the regex fallback labels it instead.
+        if config.use_llm_difficulty_check and self._difficulty_changes_prompt(config):
+            # a. Skip the LLM round-trip when exactly one cheap signal fires
+            hits = [difficulty for difficulty, pattern in _DIFFICULTY_PREFILTERS if pattern.search(question_lower)]
+            if len(hits) == 1:
+                return hits[0]
+
+            # b. Reuse an earlier classification of the same (or a near-identical) question
+            cache_key = SemanticCache.make_key(question_lower)
+            cached = _classification_cache.get(cache_key)
+            if cached is None and question_embedding is not None:
+                cached = _classification_cache.get_similar(question_embedding)
+            if cached is not None:
+                return cached
+
+            difficulty = await self._classify_with_llm(question)
+            _classification_cache.set(cache_key, difficulty, embedding=question_embedding)
+            return difficulty
             
-        # 3. Fallback to Regex if LLM check disabled
-        complex_patterns = [
-            r'^analyze\s+', r'^design\s+', r'^evaluate\s+', r'^what\s+would\s+happen',
-            r'^how\s+would\s+you\s+', r'^suggest\s+', r'^hypothesize\s+'
-        ]
-        for pattern in complex_patterns:
-            if re.search(pattern, question_lower):
-                return QuestionDifficulty.COMPLEX
+        # 3. Fallback to Regex if LLM check disabled (or pointless)
+        tokens = question_lower.split(" ", 3)
+        if _has_prefix(tokens, _COMPLEX_PREFIXES) or _COMPLEX_RE.search(question_lower):
+            return QuestionDifficulty.COMPLEX
         
-        factual_patterns = [
-            r'^what\s+is\s+', r'^what\s+are\s+', r'^where\s+is\s+', r'^when\s+did\s+',
-            r'^who\s+is\s+', r'^which\s+.*\?$', r'^define\s+', r'^list\s+', r'is\s+.*\s+the\s+'
-        ]
-        for pattern in factual_patterns:
-            if re.search(pattern, question_lower):
-                return QuestionDifficulty.FACTUAL
+        if _has_prefix(tokens, _FACTUAL_PREFIXES) or _FACTUAL_RE.search(question_lower):
+            return QuestionDifficulty.FACTUAL
                 
         return QuestionDifficulty.CONCEPTUAL
     
@@ -336,13 +616,8 @@ class TeachingAssistantAgent:
         if not config.use_socratic_prompting:
             return 0
             
-        limits = {
-            QuestionDifficulty.FACTUAL: config.socratic_prompt_limit_factual,
-            QuestionDifficulty.CONCEPTUAL: config.socratic_prompt_limit_conceptual,
-            QuestionDifficulty.APPLIED: config.socratic_prompt_limit_applied,
-            QuestionDifficulty.COMPLEX: config.socratic_prompt_limit_complex,
-        }
-        return limits.get(difficulty, 2)
+        field = _SOCRATIC_LIMIT_FIELDS.get(difficulty)
+        return getattr(config, field) if field is not None else 2
 
     def _build_adaptive_system_prompt(
         self,
@@ -359,34 +634,11 @@ class TeachingAssistantAgent:
         Returns:
             Customized system prompt with strict behavior constraints
         """
-        # Base prompt
-        base_prompt = ADAPTIVE_SYSTEM_PROMPT
-
-        # Mode 1: Direct Answer (Low limit or Socratic Mode Disabled)
+        # Direct mode is a constant; Socratic variants are memoised per limit. Either way the
+        # same string object comes back, so BaseLLMModel's config/prompt caches hash it once
         if prompt_limit <= 1:
-            return f"""{base_prompt}
-
-            ---
-            IMPORTANT INSTRUCTION: DIRECT ANSWER MODE
-            For this specific interaction, do NOT use Socratic questioning or guiding questions.
-            1. Provide a clear, direct, and complete answer immediately.
-            2. Do not ask the student to guess or "try first."
-            3. Explain the concept fully in your first response.
-            ---"""
-
-        # Mode 2: Socratic/Guiding Mode (Limit > 1)
-        else:
-            return f"""{base_prompt}
-
-            ---
-            IMPORTANT INSTRUCTION: SOCRATIC MODE (Limit: {prompt_limit} interactions)
-            You are acting as a guide. Do NOT give the answer immediately.
-            
-            1. Use your chat history to track the conversation depth.
-            2. You are allowed a MAXIMUM of {prompt_limit} guiding questions/hints for this topic.
-            3. If the student is still stuck after {prompt_limit} exchanges, you MUST stop asking questions and provide the full solution/explanation.
-            4. If the student answers correctly, validate them immediately.
-            ---"""
+            return DIRECT_ANSWER_SYSTEM_PROMPT
+        return _adaptive_system_prompt(prompt_limit)
 
     
 
@@ -433,14 +685,14 @@ class TeachingAssistantAgent:
             if result.startswith("- "):
                 result = result[2:]
 
-            print(f"LLM inferred document reference: '{result}' from question: '{question}'")
+            logger.debug("LLM inferred document reference %r from question %r", result, question)
             
             # Map the string response back to the actual Document object
             if result.upper() != "NONE":
                 for doc in group_docs:
                     # Make the matching case-insensitive and slightly more forgiving
                     if doc.filename.lower() == result.lower() or result.lower() in doc.filename.lower():
-                        logger.info(f"LLM inferred reference to document: {doc.filename}")
+                        logger.info("LLM inferred reference to document: %s", doc.filename)
                         return doc
                         
         except Exception as e:
@@ -487,92 +739,34 @@ class TeachingAssistantAgent:
         """
 
         config = active_config or self.default_config
-        # Detect question difficulty
-        difficulty = await self._detect_question_difficulty(question, config)
+
+        cached_answer, cache_key, cache_scope, question_embedding = await self._lookup_cached_answer(
+            session_id, group_id, question, config
+        )
+        if cached_answer is not None:
+            await self._replay_cached_answer(session_id, question, cached_answer)
+            return cached_answer
+
+        # Detect question difficulty and prepare the user message with optional RAG context
+        difficulty, (user_message, attachments) = await self._analyse_and_prepare(
+            session_id, group_id, question, use_rag, db_session, config, question_embedding
+        )
         prompt_limit = self._get_socratic_prompt_limit(difficulty, config)
         
-        # Build adaptive system prompt
+        # Build adaptive system prompt (a handful of fixed variants). Only variants large enough for
+        # an explicit Gemini cache touch the cache API; the rest go inline with no extra round trip.
         system_prompt = self._build_adaptive_system_prompt(difficulty, prompt_limit)
+        prompt_cache = (
+            await self.base_llm.get_prompt_cache(system_prompt)
+            if self.base_llm.is_prompt_cacheable(system_prompt) else None
+        )
 
-       # Prepare user message with optional RAG context
-        attachments = []
-        user_message = question
-
-        if use_rag and config.rag_mode != RAGMode.DISABLED:
-            if self.rag_service is None:
-                logger.warning("RAG requested but service not configured")
-            elif db_session is None:
-                logger.warning("RAG requested but db_session not provided")
-            else:
-                try:
-                    from ..services.document_service import DocumentService
-                    
-                    group_docs = DocumentService.get_group_documents(db_session, group_id, only_completed=True)
-                    
-                    # 1. Ask the LLM to infer if a file was mentioned
-                    inferred_doc = await self._infer_referenced_document(question, group_docs)
-                    
-                    # 2. If it found a match, process it natively (with caching)
-                    if inferred_doc:
-                        filename = inferred_doc.filename
-                        
-                        session = self.base_llm.get_session(session_id)
-                        if not session:
-                            session = self.create_session(session_id, group_id)
-                            
-                        if 'attached_files' not in session.metadata:
-                            session.metadata['attached_files'] = {}
-                        
-                        if filename in session.metadata['attached_files']:
-                            logger.info(f"Reusing already uploaded file reference for: {filename}")
-                            attachments.append(session.metadata['attached_files'][filename])
-                        else:
-                            full_doc = DocumentService.get_document_with_bytes(db_session, inferred_doc.id, group_id)
-                            
-                            if full_doc and full_doc.file_data:
-                                try:
-                                    mime_type = "application/pdf" if filename.endswith(".pdf") else "text/plain"
-                                    
-                                    uploaded_file = self.base_llm.upload_file_from_bytes(
-                                        file_bytes=full_doc.file_data,
-                                        mime_type=mime_type,
-                                        display_name=filename
-                                    )
-                                    attachments.append(uploaded_file)
-                                    session.metadata['attached_files'][filename] = uploaded_file
-                                    
-                                except Exception as e:
-                                    logger.error(f"Failed to upload {filename} to Gemini: {e}")
-
-                        # ADD THE CRITICAL ALIAS MAPPING INSTRUCTION HERE
-                        user_message += (
-                            f"\n\n[CRITICAL SYSTEM NOTE: The user is casually asking about their document. "
-                            f"Assume any casual phrasing like 'my FYP', 'the report', or 'my notes' refers EXACTLY to '{filename}'. "
-                            f"The retrieved chunks below or attached files belong to this document. Do NOT claim you lack access to it.]"
-                        )
-
-                    # 3. Pass the ORIGINAL 'question' so vector search isn't corrupted
-                    rag_enhanced_prompt = self._prepare_message_with_rag(
-                        question, group_id, db_session, config
-                    )
-                    
-                    # Combine the RAG string with our modified user_message safely
-                    if f"Student Question: {question}" in rag_enhanced_prompt:
-                        user_message = rag_enhanced_prompt.replace(
-                            f"Student Question: {question}", 
-                            f"Student Question: {user_message}"
-                        )
-                    else:
-                        user_message = f"{rag_enhanced_prompt}\n\nStudent Question: {user_message}"
-                        
-                except Exception as e:
-                    logger.error(f"RAG retrieval failed: {str(e)}")
-
-        temperature = custom_temperature or config.temperature
-        top_p = custom_top_p or config.top_p
-        top_k = custom_top_k or config.top_k
+        temperature = custom_temperature if custom_temperature is not None else config.temperature
+        top_p = custom_top_p if custom_top_p is not None else config.top_p
+        top_k = custom_top_k if custom_top_k is not None else config.top_k
 
-        response = await self.base_llm.generate_response(
+        # Concurrent students share the process-wide LLM window instead of each opening a call at once
+        response = await llm_batcher.submit(self.base_llm.generate_response(
             session_id=session_id,
             user_message=user_message,
             system_prompt=system_prompt,
@@ -582,7 +776,11 @@ class TeachingAssistantAgent:
             max_output_tokens=config.max_output_tokens,
             use_chat_history=True,
             attachments=attachments,
-        )
+            cached_content=prompt_cache,
+        ), long_output=difficulty in _LONG_OUTPUT_DIFFICULTIES)
+
+        if response and cache_key is not None:
+            _answer_cache.set(cache_key, response, embedding=question_embedding, scope=cache_scope)
 
         return response
 
@@ -623,101 +821,37 @@ class TeachingAssistantAgent:
         # Determine configuration to use
         config = active_config or self.default_config
 
-        # Detect question difficulty
-        difficulty = await self._detect_question_difficulty(question, config)
+        cached_answer, cache_key, cache_scope, question_embedding = await self._lookup_cached_answer(
+            session_id, group_id, question, config
+        )
+        if cached_answer is not None:
+            await self._replay_cached_answer(session_id, question, cached_answer)
+            yield cached_answer
+            return
+
+        # Detect question difficulty and prepare the user message with optional RAG context
+        difficulty, (user_message, attachments) = await self._analyse_and_prepare(
+            session_id, group_id, question, use_rag, db_session, config, question_embedding
+        )
         prompt_limit = self._get_socratic_prompt_limit(difficulty, config)
         
-        # Build adaptive system prompt
+        # Build adaptive system prompt (a handful of fixed variants). Only variants large enough for
+        # an explicit Gemini cache touch the cache API; the rest go inline with no extra round trip.
         system_prompt = self._build_adaptive_system_prompt(difficulty, prompt_limit)
-
-        # Prepare user message with optional RAG context
-        attachments = []
-        user_message = question
-
-        clean_question = question.split(": ", 1)[-1] if ": " in question else question
-
-        if use_rag and config.rag_mode != RAGMode.DISABLED:
-            if self.rag_service is None:
-                logger.warning("RAG requested but service not configured, proceeding without RAG")
-            elif db_session is None:
-                logger.warning("RAG requested but db_session not provided, proceeding without RAG")
-            else:
-                try:
-                    
-                    group_docs = DocumentService.get_group_documents(db_session, group_id, only_completed=True)
-                    
-                    # 1. Ask the LLM to infer if a file was mentioned
-                    inferred_doc = await self._infer_referenced_document(question, group_docs)
-                    
-                    # 2. If it found a match, process it natively (with caching)
-                    if inferred_doc:
-                        filename = inferred_doc.filename
-                        
-                        # Fetch or Create Session to access state metadata
-                        session = self.base_llm.get_session(session_id)
-                        if not session:
-                            session = self.create_session(session_id, group_id)
-                            
-                        # Initialize attachment cache if it doesn't exist
-                        if 'attached_files' not in session.metadata:
-                            session.metadata['attached_files'] = {}
-                        
-                        # CHECK: Has this file already been uploaded in this session?
-                        if filename in session.metadata['attached_files']:
-                            logger.info(f"Reusing already uploaded file reference for: {filename}")
-                            # Reuse the existing API file URI instead of re-uploading bytes
-                            attachments.append(session.metadata['attached_files'][filename])
-                        else:
-                            # FIRST TIME: Upload and cache the file
-                            full_doc = DocumentService.get_document_with_bytes(db_session, inferred_doc.id, group_id)
-                            
-                            if full_doc and full_doc.file_data:
-                                try:
-                                    mime_type = "application/pdf" if filename.endswith(".pdf") else "text/plain"
-                                    
-                                    uploaded_file = self.base_llm.upload_file_from_bytes(
-                                        file_bytes=full_doc.file_data,
-                                        mime_type=mime_type,
-                                        display_name=filename
-                                    )
-                                    attachments.append(uploaded_file)
-                                    
-                                    # Save the Google API file reference to the session metadata
-                                    session.metadata['attached_files'][filename] = uploaded_file
-                                    
-                                except Exception as e:
-                                    logger.error(f"Failed to upload {filename} to Gemini: {e}")
-
-                        # ADD THE CRITICAL ALIAS MAPPING INSTRUCTION HERE
-                        user_message += (
-                            f"\n\n[CRITICAL SYSTEM NOTE: The user is casually asking about their document. "
-                            f"Assume any casual phrasing like 'my FYP', 'the report', or 'my notes' refers EXACTLY to '{filename}'. "
-                            f"The retrieved chunks below or attached files belong to this document. Do NOT claim you lack access to it.]"
-                        )
-
-                    # 3. FIX: Pass the ORIGINAL 'question' so vector search isn't corrupted
-                    rag_enhanced_prompt = self._prepare_message_with_rag(
-                        clean_question, group_id, db_session, config
-                    )
-                    
-                    # Combine the RAG string with our modified user_message safely
-                    if f"Student Question: {clean_question}" in rag_enhanced_prompt:
-                        user_message = rag_enhanced_prompt.replace(
-                            f"Student Question: {clean_question}", 
-                            f"Student Question: {user_message}"
-                        )
-                    else:
-                        user_message = f"{rag_enhanced_prompt}\n\nStudent Question: {user_message}"
-                        
-                except Exception as e:
-                    logger.error(f"RAG retrieval failed: {str(e)}, proceeding without RAG")
+        prompt_cache = (
+            await self.base_llm.get_prompt_cache(system_prompt)
+            if self.base_llm.is_prompt_cacheable(system_prompt) else None
+        )
 
         # Generate response
-        temperature = custom_temperature or config.temperature
-        top_p = custom_top_p or config.top_p
-        top_k = custom_top_k or config.top_k
+        temperature = custom_temperature if custom_temperature is not None else config.temperature
+        top_p = custom_top_p if custom_top_p is not None else config.top_p
+        top_k = custom_top_k if custom_top_k is not None else config.top_k
+
+        # Collected so a completed stream warms the answer cache too
+        chunks: List[str] = []
 
-        async for chunk in self.base_llm.generate_response_stream(
+        async for chunk in llm_batcher.stream(self.base_llm.generate_response_stream(
             session_id=session_id,
             user_message=user_message,
             system_prompt=system_prompt,
@@ -727,69 +861,199 @@ class TeachingAssistantAgent:
             max_output_tokens=config.max_output_tokens,
             use_chat_history=True,
             attachments=attachments, # Pass attachments such as full uploaded documents if needed
-        ):
+            cached_content=prompt_cache,
+        ), long_output=difficulty in _LONG_OUTPUT_DIFFICULTIES):
+            chunks.append(chunk)
             yield chunk
 
-    def _prepare_message_with_rag(
+        if chunks and cache_key is not None:
+            _answer_cache.set(cache_key, "".join(chunks), embedding=question_embedding, scope=cache_scope)
+
+    async def _analyse_and_prepare(
         self,
+        session_id: str,
+        group_id: int,
         question: str,
+        use_rag: bool,
+        db_session,
+        config: TAConfig,
+        question_embedding: Optional[List[float]]
+    ) -> Tuple[QuestionDifficulty, Tuple[str, List[Any]]]:
+        """
+        Difficulty detection and RAG preparation don't depend on each other, so they run
+        concurrently and the turn waits for the slower of the two rather than their sum.
+
+        Returns (difficulty, (user_message, attachments)).
+        """
+        if not use_rag or config.rag_mode == RAGMode.DISABLED:
+            difficulty = await self._detect_question_difficulty(question, config, question_embedding)
+            return difficulty, (question, [])
+
+        clean_question = question.split(": ", 1)[-1] if ": " in question else question
+        # Neither raises: both fall back (CONCEPTUAL / bare question) on failure
+        return await asyncio.gather(
+            self._detect_question_difficulty(question, config, question_embedding),
+            self._prepare_user_message(
+                session_id, group_id, question, clean_question, db_session, config,
+                query_embedding=question_embedding
+            )
+        )
+
+    async def _prepare_user_message(
+        self,
+        session_id: str,
         group_id: int,
+        question: str,
+        rag_query: str,
         db_session,
-        config: TAConfig
+        config: TAConfig,
+        query_embedding: Optional[List[float]] = None
+    ) -> Tuple[str, List[Any]]:
+        """
+        Build the RAG-enhanced user turn and any document attachments for a question.
+
+        Retrieval (vector search in a worker thread) and the LLM check for a referenced
+        document run concurrently, so their round-trips overlap instead of adding up.
+        The DB session is only used by the retrieval thread until both have finished.
+        `query_embedding` (of rag_query, from the answer cache lookup) saves re-embedding it.
+
+        Returns (user_message, attachments). Falls back to the bare question on failure.
+        """
+        attachments = []
+        user_message = question
+
+        if self.rag_service is None:
+            logger.warning("RAG requested but service not configured, proceeding without RAG")
+            return user_message, attachments
+        if db_session is None:
+            logger.warning("RAG requested but db_session not provided, proceeding without RAG")
+            return user_message, attachments
+
+        try:
+            group_docs = DocumentService.get_group_documents(db_session, group_id, only_completed=True)
+
+            # 1. Retrieve context and ask the LLM whether a file was mentioned, in parallel.
+            #    Retrieval uses the cleaned question so vector search isn't skewed by the username.
+            rag_context, inferred_doc = await asyncio.gather(
+                self._prepare_message_with_rag(rag_query, group_id, db_session, config, query_embedding),
+                self._infer_referenced_document(question, group_docs),
+                return_exceptions=True
+            )
+            if isinstance(rag_context, Exception):
+                logger.error(f"RAG retrieval failed: {str(rag_context)}, proceeding without RAG")
+                rag_context = None
+            if isinstance(inferred_doc, Exception):
+                logger.error(f"Failed to infer document reference: {inferred_doc}")
+                inferred_doc = None
+
+            # 2. If it found a match, process it natively (with caching)
+            if inferred_doc:
+                filename = inferred_doc.filename
+
+                session = await self.base_llm.aget_or_create_session(session_id, group_id)
+
+                if 'attached_files' not in session.metadata:
+                    session.metadata['attached_files'] = {}
+
+                if filename in session.metadata['attached_files']:
+                    logger.info("Reusing already uploaded file reference for: %s", filename)
+                    attachments.append(session.metadata['attached_files'][filename])
+                else:
+                    full_doc = DocumentService.get_document_with_bytes(db_session, inferred_doc.id, group_id)
+
+                    if full_doc and full_doc.file_data:
+                        try:
+                            mime_type = "application/pdf" if filename.endswith(".pdf") else "text/plain"
+
+                            uploaded_file = await self.base_llm.aupload_file_from_bytes(
+                                file_bytes=full_doc.file_data,
+                                mime_type=mime_type,
+                                display_name=filename
+                            )
+                            attachments.append(uploaded_file)
+                            session.metadata['attached_files'][filename] = uploaded_file
+                            await self.base_llm.asave_session(session)
+
+                        except Exception as e:
+                            logger.error(f"Failed to upload {filename} to Gemini: {e}")
+
+                # Alias mapping instruction so casual references resolve to the file
+                user_message += (
+                    f"\n\n[CRITICAL SYSTEM NOTE: The user is casually asking about their document. "
+                    f"Assume any casual phrasing like 'my FYP', 'the report', or 'my notes' refers EXACTLY to '{filename}'. "
+                    f"The retrieved chunks below or attached files belong to this document. Do NOT claim you lack access to it.]"
+                )
+
+            # 3. Stable materials block first, the per-turn question (with any note) last.
+            #    One join, so the (often several KB) context is copied once
+            if rag_context is not None:
+                user_message = "".join((_RAG_MATERIALS_PREFIX, rag_context, _RAG_QUESTION_PREFIX, user_message))
+
+        except Exception as e:
+            logger.error(f"RAG preparation failed: {str(e)}, proceeding without RAG")
+
+        return user_message, attachments
+
+    async def _prepare_message_with_rag(
+        self,
+        question: str,
+        group_id: int,
+        db_session,
+        config: TAConfig,
+        query_embedding: Optional[List[float]] = None
     ) -> str:
-        """Retrieve relevant context using RAG and prepare enhanced message."""
+        """Retrieve relevant context using RAG and return it formatted for the materials block."""
         
         # Configure RAG based on the provided agent config
-        rag_config = RAGConfig(
-            include_documents=(
-                config.rag_mode in [RAGMode.DOCUMENTS_ONLY, RAGMode.BOTH]
-            ),
-            include_conversations=(
-                config.rag_mode in [RAGMode.CONVERSATIONS_ONLY, RAGMode.BOTH]
-            ),
-            top_k_documents=3,
-            top_k_conversations=3
-        )
+        rag_config = _RAG_CONFIGS[config.rag_mode, config.low_latency_rag]
 
-        # Retrieve context
-        context_dict = RAGService.retrieve_context(
+        # Retrieve and format context (cached per group, settings and normalised question;
+        # invalidated when the group's documents or conversation chunks change)
+        context_dict, formatted_context = await asyncio.to_thread(
+            RAGService.retrieve_formatted_context,
             db=db_session,
             query=question,
             group_id=group_id,
-            config=rag_config
+            config=rag_config,
+            query_embedding=query_embedding
         )
 
-        # Format context for prompt
-        formatted_context = RAGService.format_context_for_prompt(
-            context=context_dict,
-            config=rag_config
+        logger.debug(
+            "RAG for %r: %d docs, %d conversations retrieved; context:\n%s",
+            question,
+            len(context_dict.get('documents', [])),
+            len(context_dict.get('conversations', [])),
+            formatted_context,
         )
 
-        # === ADD DEBUG PRINT STATEMENTS HERE ===
-        print("\n" + "="*40)
-        print(f"DEBUG RAG - Question: '{question}'")
-        print(f"DEBUG RAG - Docs Retrieved: {len(context_dict.get('documents', []))}")
-        print(f"DEBUG RAG - Convs Retrieved: {len(context_dict.get('conversations', []))}")
-        print("DEBUG RAG - Formatted Context going to LLM:")
-        print(formatted_context)
-        print("="*40 + "\n")
-        # =======================================
-
-        # Prepare enhanced message with Explicit Citation Prompting
-        enhanced_message = (
-            f"SYSTEM: I have automatically retrieved the following study materials for you. "
-            f"Please EVALUATE their relevance to the student's question:\n"
-            f"1. If the materials contain the answer, you MUST use them and STRICTLY cite the source document name inline (e.g., 'According to [Filename.pdf], ...' or '... as shown in the materials [Filename.pdf]').\n"
-            f"2. If the materials are IRRELEVANT (e.g., matched on keywords but wrong topic), "
-            f"IGNORE them completely and answer based on your general knowledge.\n"
-            f"3. Do NOT force a connection if none exists.\n\n"
-            f"--- RETRIEVED MATERIALS ---\n"
-            f"{formatted_context}\n"
-            f"--- END MATERIALS ---\n\n"
-            f"Student Question: {question}"
-        )
-        
-        return enhanced_message
+        return formatted_context
+
+    async def answer_many(self, requests: List[AnswerRequest]) -> List[Any]:
+        """
+        Answer several questions (e.g. different sessions in a group) concurrently.
+
+        Each request gets its own DB session, since RAG retrieval runs in worker threads and
+        a SQLAlchemy Session must not be shared between them. Results are returned in input
+        order; a failed request yields its exception instead of failing the whole batch.
+        """
+        from ..core.database import SessionLocal
+
+        async def _answer(request: AnswerRequest) -> str:
+            db = SessionLocal() if request.use_rag else None
+            try:
+                return await self.answer_question(
+                    session_id=request.session_id,
+                    group_id=request.group_id,
+                    question=request.question,
+                    use_rag=request.use_rag,
+                    db_session=db,
+                    active_config=request.active_config,
+                )
+            finally:
+                if db is not None:
+                    db.close()
+
+        return await asyncio.gather(*(_answer(r) for r in requests), return_exceptions=True)
 
     # ========================
     # Session Management (delegated to BaseLLMModel)
@@ -818,7 +1082,7 @@ class TeachingAssistantAgent:
             metadata=metadata
         )
     
-    def get_session_history(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+    def get_session_history(self, session_id: str) -> Optional[Tuple[Dict[str, str], ...]]:
         """Get chat history for a session."""
         return self.base_llm.get_session_history(session_id)
     
@@ -1,69 +1,83 @@
 # app/api/v1/agent_config.py
+import logging
+from typing import Optional
+
 from fastapi import APIRouter, Depends, HTTPException, Header
 from sqlalchemy.orm import Session
 
 from ...core.database import get_db
-from ...models.study_group_membership import StudyGroupMembership, MemberRole
+from ...models.study_group_membership import MemberRole
 from ...agents.teaching_agent import RAGMode, QuestionDifficulty
 from ...services.agent_config_service import AgentConfigService
+from ...services.study_group_service import StudyGroupService
 
 # Import the shared teaching_agent and helper from chat.py
 from .chat import get_user_from_token
 
-router = APIRouter(prefix="/agent-config", tags=["agent-config"])
+logger = logging.getLogger(__name__)
 
+router = APIRouter(prefix="/agent-config", tags=["agent-config"])
 
 # Helper to extract token from Authorization header
 def get_token_from_header(authorization: str = Header(None)) -> str | None:
     """Extract Bearer token from Authorization header."""
-    print(f"[Agent Config] Raw Authorization header: {authorization}")
-    
     if not authorization:
-        print("[Agent Config] No authorization header received!")
+        logger.debug("No authorization header received")
         return None
     
     # Authorization header format: "Bearer <token>"
     parts = authorization.split()
-    print(f"[Agent Config] Split parts: {len(parts)} parts")
     
     if len(parts) == 2 and parts[0].lower() == "bearer":
         token = parts[1]
-        print(f"[Agent Config] Extracted token: {token[:20]}... (length: {len(token)})")
-        print(f"[Agent Config] Token segments: {len(token.split('.'))}")
+        logger.debug("Extracted bearer token (length: %d)", len(token))
         return token
     
-    print(f"[Agent Config] Invalid authorization format: {parts}")
+    logger.debug("Invalid authorization format (%d parts)", len(parts))
     return None
 
 
-@router.get("/{group_id}")
-async def get_agent_config(
+def _authorized_role(group_id: int, db: Session, authorization: Optional[str]) -> Optional[MemberRole]:
+    token = get_token_from_header(authorization)
+    user = get_user_from_token(token, db) if token else None
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return StudyGroupService.get_member_role(db, group_id, user.id)
+
+
+def require_member(
+    group_id: int,
+    db: Session = Depends(get_db),
+    authorization: str = Header(None),
+) -> None:
+    """Dependency: caller must be an active member of the group."""
+    if _authorized_role(group_id, db, authorization) is None:
+        raise HTTPException(status_code=403, detail="Not a member of this group")
+
+
+def require_admin_member(
     group_id: int,
     db: Session = Depends(get_db),
     authorization: str = Header(None),
+) -> None:
+    """Dependency: caller must be an active admin of the group."""
+    if _authorized_role(group_id, db, authorization) != MemberRole.ADMIN:
+        raise HTTPException(
+            status_code=403, detail="Only admins can change agent settings"
+        )
+
+
+@router.get("/{group_id}")
+def get_agent_config(
+    group_id: int,
+    db: Session = Depends(get_db),
+    _: None = Depends(require_member),
 ):
     """
     Get current teaching agent configuration for a group.
 
     This returns the global agent config (all groups share same agent).
     """
-    token = get_token_from_header(authorization)
-    user = get_user_from_token(token, db) if token else None
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    membership = (
-        db.query(StudyGroupMembership)
-        .filter(
-            StudyGroupMembership.group_id == group_id,
-            StudyGroupMembership.user_id == user.id,
-            StudyGroupMembership.is_active == True,
-        )
-        .first()
-    )
-    if not membership:
-        raise HTTPException(status_code=403, detail="Not a member of this group")
-
     status = AgentConfigService.get_ta_config(db, group_id)
 
     return {
@@ -82,33 +96,13 @@ async def get_agent_config(
 
 
 @router.post("/{group_id}/rag-mode")
-async def update_rag_mode(
+def update_rag_mode(
     group_id: int,
     rag_mode: str,
     db: Session = Depends(get_db),
-    authorization: str = Header(None),
+    _: None = Depends(require_admin_member),
 ):
     """Update RAG mode. Admin only."""
-    token = get_token_from_header(authorization)
-    user = get_user_from_token(token, db) if token else None
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    membership = (
-        db.query(StudyGroupMembership)
-        .filter(
-            StudyGroupMembership.group_id == group_id,
-            StudyGroupMembership.user_id == user.id,
-            StudyGroupMembership.role == MemberRole.ADMIN,
-            StudyGroupMembership.is_active == True,
-        )
-        .first()
-    )
-    if not membership:
-        raise HTTPException(
-            status_code=403, detail="Only admins can change agent settings"
-        )
-
     valid_modes = ["disabled", "documents_only", "conversations_only", "both"]
     if rag_mode not in valid_modes:
         raise HTTPException(
@@ -129,33 +123,13 @@ async def update_rag_mode(
 
 
 @router.post("/{group_id}/socratic-mode")
-async def update_socratic_mode(
+def update_socratic_mode(
     group_id: int,
     enabled: bool,
     db: Session = Depends(get_db),
-    authorization: str = Header(None),
+    _: None = Depends(require_admin_member),
 ):
     """Enable/disable Socratic prompting. Admin only."""
-    token = get_token_from_header(authorization)
-    user = get_user_from_token(token, db) if token else None
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    membership = (
-        db.query(StudyGroupMembership)
-        .filter(
-            StudyGroupMembership.group_id == group_id,
-            StudyGroupMembership.user_id == user.id,
-            StudyGroupMembership.role == MemberRole.ADMIN,
-            StudyGroupMembership.is_active == True,
-        )
-        .first()
-    )
-    if not membership:
-        raise HTTPException(
-            status_code=403, detail="Only admins can change agent settings"
-        )
-
     try:
         AgentConfigService.update_config(db, group_id, {"use_socratic_prompting": enabled})
         
@@ -169,36 +143,16 @@ async def update_socratic_mode(
 
 
 @router.post("/{group_id}/socratic-limits")
-async def update_socratic_limits(
+def update_socratic_limits(
     group_id: int,
     factual: int | None = None,
     conceptual: int | None = None,
     applied: int | None = None,
     complex: int | None = None,
     db: Session = Depends(get_db),
-    authorization: str = Header(None),
+    _: None = Depends(require_admin_member),
 ):
     """Update Socratic limits. Admin only."""
-    token = get_token_from_header(authorization)
-    user = get_user_from_token(token, db) if token else None
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    membership = (
-        db.query(StudyGroupMembership)
-        .filter(
-            StudyGroupMembership.group_id == group_id,
-            StudyGroupMembership.user_id == user.id,
-            StudyGroupMembership.role == MemberRole.ADMIN,
-            StudyGroupMembership.is_active == True,
-        )
-        .first()
-    )
-    if not membership:
-        raise HTTPException(
-            status_code=403, detail="Only admins can change agent settings"
-        )
-
     try:
         if factual is not None:
             AgentConfigService.update_config(db, group_id, {"limit_factual": factual})
@@ -229,33 +183,13 @@ async def update_socratic_limits(
 
 
 @router.post("/{group_id}/temperature")
-async def update_temperature(
+def update_temperature(
     group_id: int,
     temperature: float,
     db: Session = Depends(get_db),
-    authorization: str = Header(None),
+    _: None = Depends(require_admin_member),
 ):
     """Update temperature. Admin only."""
-    token = get_token_from_header(authorization)
-    user = get_user_from_token(token, db) if token else None
-    if not user:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    membership = (
-        db.query(StudyGroupMembership)
-        .filter(
-            StudyGroupMembership.group_id == group_id,
-            StudyGroupMembership.user_id == user.id,
-            StudyGroupMembership.role == MemberRole.ADMIN,
-            StudyGroupMembership.is_active == True,
-        )
-        .first()
-    )
-    if not membership:
-        raise HTTPException(
-            status_code=403, detail="Only admins can change agent settings"
-        )
-
     try:
 
         AgentConfigService.update_config(db, group_id, {"temperature": temperature})
@@ -1,10 +1,13 @@
+import asyncio
 from datetime import timedelta
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from jose import jwt, JWTError
+import jwt
 from ...core.database import get_db
-from ...core.security import create_access_token, get_current_user, verify_password, get_password_hash, SECRET_KEY, ALGORITHM
+from ...core.security import create_access_token, get_current_user, verify_password, get_password_hash, SECRET_KEY, ALGORITHMS
 from ...schemas.auth import LoginRequest, RegisterRequest, AuthResponse, TokenResponse, RefreshTokenRequest
 from ...models.user import User
 from ...services.email_service import email_service
@@ -17,17 +20,8 @@ async def register(
     db: Session = Depends(get_db)
 ):
     """Register a new user"""
-    existing_user = db.query(User).filter(
-        (User.email == user_data.email) | (User.username == user_data.username)
-    ).first()
-    
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email or username already registered"
-        )
-    
-    hashed_password = get_password_hash(user_data.password)
+    # bcrypt is deliberately slow; hash in a worker thread so the event loop keeps serving
+    hashed_password = await asyncio.to_thread(get_password_hash, user_data.password)
     db_user = User(
         username=user_data.username,
         email=user_data.email,
@@ -37,8 +31,16 @@ async def register(
         is_verified=False # Ensure it's False
     )
     
+    # The unique email/username indexes reject duplicates; no separate lookup, no race window
     db.add(db_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email or username already registered"
+        )
     db.refresh(db_user)
     
     # Create verification token (lasts 24 hours)
@@ -59,9 +61,14 @@ async def login(
     db: Session = Depends(get_db)
 ):
     """Login user"""
-    user = db.query(User).filter(User.email == login_data.email).first()
+    user = db.execute(
+        select(User).where(User.email == login_data.email).limit(1)
+    ).scalar_one_or_none()
     
-    if not user or not verify_password(login_data.password, user.hashed_password):
+    password_ok = await asyncio.to_thread(
+        verify_password, login_data.password, user.hashed_password if user else None
+    )
+    if not user or not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
@@ -98,7 +105,7 @@ async def login(
 @router.get("/verify-email")
 async def verify_email(token: str, db: Session = Depends(get_db)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=ALGORITHMS)
         email: str = payload.get("sub")
         token_type: str = payload.get("type")
         
@@ -117,7 +124,7 @@ async def verify_email(token: str, db: Session = Depends(get_db)):
         
         return {"message": "Email successfully verified."}
         
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid or expired verification token")
     
 
@@ -140,7 +147,7 @@ async def refresh_token(
     """Refresh access token"""
     try:
         # Decode the refresh token
-        payload = jwt.decode(request.refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(request.refresh_token, SECRET_KEY, algorithms=ALGORITHMS)
         email: str = payload.get("sub")
         
         if email is None:
@@ -170,7 +177,7 @@ async def refresh_token(
             token_type="bearer"
         )
         
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired refresh token"
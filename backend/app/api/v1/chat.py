@@ -1,13 +1,14 @@
 # app/api/v1/chat.py
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, UploadFile, File
-from sqlalchemy.orm import Session
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session, selectinload
 from pydantic import BaseModel
 from datetime import datetime, timezone
-from typing import Optional
-import json
+from typing import Any, Dict, List, Optional
+import orjson
 import asyncio
+import logging
 import re
-from jose import jwt, JWTError
 from uuid import UUID
 
 # Core and services
@@ -38,6 +39,7 @@ from ...agents.summarising_agent import SummarisingAgent
 
 
 router = APIRouter(prefix="/chat", tags=["chat"])
+logger = logging.getLogger(__name__)
 
 # Singleton LLM Client (Keeps connections/session cache efficient)
 base_llm = BaseLLMModel()
@@ -70,7 +72,10 @@ async def extract_context_from_file(
         raise HTTPException(status_code=400, detail="Filename is missing")
     try:
         content_bytes = await file.read()
-        extracted_text = DocumentService.extract_text_from_bytes(file.filename, content_bytes)
+        # PDF/DOCX parsing is CPU-bound; keep it off the event loop serving the chat sockets
+        extracted_text = await asyncio.to_thread(
+            DocumentService.extract_text_from_bytes, file.filename, content_bytes
+        )
         return { "filename": file.filename, "content": extracted_text }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process file: {str(e)}")
@@ -108,15 +113,18 @@ def fetch_quiz_context(db: Session, attempt_id: int, user_id: UUID) -> str:
     return context
 
 
+# Compiled once; checked against every chat message
+_AI_MENTION_RE = re.compile(r'@Bob\s*', re.IGNORECASE)
+
 def detect_ai_mention(content: str) -> bool:
     """Check if message mentions @Bob"""
-    return "@Bob" in content or "@bob" in content.lower()
+    # One case-insensitive scan, without lowercasing a copy of the message
+    return _AI_MENTION_RE.search(content) is not None
 
 def remove_ai_mention(content: str) -> str:
     """Remove @Bob mention from message"""
     # Remove @Bob (case insensitive)
-    cleaned = re.sub(r'@Bob\s*', '', content, flags=re.IGNORECASE)
-    return cleaned.strip()
+    return _AI_MENTION_RE.sub('', content).strip()
 
 async def stream_ai_response(
     websocket: WebSocket, 
@@ -140,8 +148,7 @@ async def stream_ai_response(
             session_id = f"group_{group_id}"
 
         # Initialize session if it doesn't exist
-        if not teaching_agent.base_llm.get_session(session_id):
-            teaching_agent.create_session(session_id=session_id, group_id=group_id)
+        await teaching_agent.base_llm.aget_or_create_session(session_id, group_id)
 
         
         # Add quiz attempt to context if necessary
@@ -150,7 +157,7 @@ async def stream_ai_response(
             if quiz_context:
                 # We inject this as a system message into the session history directly
                 # so the model "remembers" it for this turn
-                teaching_agent.base_llm.add_message_to_history(
+                await teaching_agent.base_llm.aadd_message_to_history(
                     session_id=session_id,
                     role="system",
                     content=quiz_context
@@ -186,22 +193,25 @@ async def stream_ai_response(
             active_config=active_config
         )
         
-        async for chunk in stream_generator:
-            full_response.append(chunk)
-            
-            chunk_payload = {
-                "type": "ai_stream",
-                "content": chunk,
-                "is_final": False
-            }
-
-            # ROUTING LOGIC
-            if is_private:
-                await websocket.send_json(chunk_payload)
-            else:
-                await manager.broadcast_to_group(chunk_payload, group_id)
-
-            await asyncio.sleep(0.01)
+        try:
+            async for chunk in stream_generator:
+                full_response.append(chunk)
+                
+                chunk_payload = {
+                    "type": "ai_stream",
+                    "content": chunk,
+                    "is_final": False
+                }
+
+                # ROUTING LOGIC
+                if is_private:
+                    await websocket.send_text(orjson.dumps(chunk_payload).decode())
+                else:
+                    await manager.broadcast_to_group(chunk_payload, group_id)
+        finally:
+            # If the private viewer disconnected (send raised), close the LLM stream now
+            # rather than leaving it generating, and holding its LLM slot, until GC
+            await stream_generator.aclose()
 
         # 5. Finalize and Save
         complete_response = "".join(full_response)
@@ -229,17 +239,24 @@ async def stream_ai_response(
         else:
             await manager.broadcast_to_group(final_payload, group_id)
         
+    except WebSocketDisconnect:
+        # Private viewer left mid-answer; nobody to report to
+        logger.info("[AI Stream] Client disconnected, stream cancelled")
     except Exception as e:
-        print(f"[AI Stream Error] {str(e)}")
+        logger.error("[AI Stream Error] %s", e)
         error_payload = {
             "type": "ai_error",
             "content": "Sorry, I encountered an error. Please try again."
         }
         
-        if is_private:
-            await websocket.send_json(error_payload)
-        else:
-            await manager.broadcast_to_group(error_payload, group_id)
+        try:
+            if is_private:
+                await websocket.send_json(error_payload)
+            else:
+                await manager.broadcast_to_group(error_payload, group_id)
+        except (WebSocketDisconnect, RuntimeError):
+            # Socket already closed (the usual cause of the error above)
+            pass
 
 
 
@@ -257,13 +274,7 @@ async def websocket_endpoint(websocket: WebSocket, group_id: int, db: Session =
         await websocket.close(code=1008, reason="Invalid/expired token")
         return
     
-    membership = db.query(StudyGroupMembership).filter(
-        StudyGroupMembership.group_id == group_id,
-        StudyGroupMembership.user_id == user.id,
-        StudyGroupMembership.is_active == True
-    ).first()
-    
-    if not membership:
+    if StudyGroupService.get_member_role(db, group_id, user.id) is None:
         await websocket.close(code=1008, reason="Not a member")
         return
 
@@ -281,7 +292,7 @@ async def websocket_endpoint(websocket: WebSocket, group_id: int, db: Session =
                 break
 
 
-            payload = json.loads(text)
+            payload = orjson.loads(text)
             # Extract mode (default to 'public')
             chat_mode = payload.get("mode", "public") 
             content = payload.get("content", "").strip()
@@ -308,8 +319,7 @@ async def websocket_endpoint(websocket: WebSocket, group_id: int, db: Session =
                 teaching_agent = get_agent_for_group(group_id, db)
                 
                 # Ensure session exists
-                if not teaching_agent.base_llm.get_session(private_session_id):
-                    teaching_agent.create_session(session_id=private_session_id, group_id=group_id)
+                await teaching_agent.base_llm.aget_or_create_session(private_session_id, group_id)
 
                 # === INJECT TEMPORARY CONTEXT (Hidden) ===
                 # If the frontend sent extracted file text, we add it as a SYSTEM message.
@@ -320,7 +330,7 @@ async def websocket_endpoint(websocket: WebSocket, group_id: int, db: Session =
                     text_content = item.get("content", "")
                     
                     # Inject into History (Hidden from User UI, visible to AI)
-                    teaching_agent.base_llm.add_message_to_history(
+                    await teaching_agent.base_llm.aadd_message_to_history(
                         session_id=private_session_id,
                         role="system", 
                         # We use 'system' or 'model' role so it acts as context
@@ -391,13 +401,7 @@ async def get_messages(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    membership = db.query(StudyGroupMembership).filter(
-        StudyGroupMembership.group_id == group_id,
-        StudyGroupMembership.user_id == current_user.id,
-        StudyGroupMembership.is_active == True
-    ).first()
-    
-    if not membership:
+    if StudyGroupService.get_member_role(db, group_id, current_user.id) is None:
         raise HTTPException(status_code=403, detail="Not a member of this group")
     
     # 2. Fetch Based on Mode
@@ -410,7 +414,7 @@ async def get_messages(
             db, group_id, limit=limit, offset=offset
         )
         
-    return [MessageService.format_message_for_ws(m, db) for m in messages]
+    return MessageService.format_messages_for_ws(messages, db)
 
 
 # Endpoints for missed message count and summarisation
@@ -468,16 +472,12 @@ def update_last_viewed(
     return {"status": "updated"}
 
 
-@router.post("/groups/{group_id}/summarise_missed", response_model=SummaryResponse)
-async def summarise_missed_messages(
-    group_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
+def _load_missed_messages(db: Session, group_id: int, user: User) -> List[Dict[str, Any]]:
+    """Messages the user missed since they last viewed the group, formatted for the summarising agent."""
     # 1. Get last viewed
     membership = db.query(StudyGroupMembership).filter(
         StudyGroupMembership.group_id == group_id,
-        StudyGroupMembership.user_id == current_user.id
+        StudyGroupMembership.user_id == user.id
     ).first()
     
     if not membership or not membership.last_viewed_at:
@@ -486,7 +486,7 @@ async def summarise_missed_messages(
     else:
         # 2. Fetch missed messages
         # Note: MessageService might need a new method or we query directly here
-        messages_orm = db.query(StudyGroupMessage).filter(
+        messages_orm = db.query(StudyGroupMessage).options(selectinload(StudyGroupMessage.user)).filter(
             StudyGroupMessage.group_id == group_id,
             StudyGroupMessage.created_at > membership.last_viewed_at
         ).order_by(StudyGroupMessage.created_at.asc()).all()
@@ -497,17 +497,43 @@ async def summarise_missed_messages(
             
         messages = messages_orm
 
-    if not messages:
-        return SummaryResponse(summary="No missed messages to summarise.")
-
-    # 3. Format for Agent
+    # 3. Format for Agent (ids let the agent extend an earlier summary of the same backlog)
     formatted_msgs = []
     for m in messages:
         # Resolving username might require a join or helper, assuming simple access here
         username = m.user.username if m.user else "Bob the Bot"
-        formatted_msgs.append({"username": username, "content": m.content})
+        formatted_msgs.append({"id": m.id, "username": username, "content": m.content})
+    return formatted_msgs
+
+
+@router.post("/groups/{group_id}/summarise_missed", response_model=SummaryResponse)
+async def summarise_missed_messages(
+    group_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    formatted_msgs = _load_missed_messages(db, group_id, current_user)
+    if not formatted_msgs:
+        return SummaryResponse(summary="No missed messages to summarise.")
 
     # 4. Generate
-    summary_text = await summarising_agent.summarise_chat(formatted_msgs)
+    summary_text = await summarising_agent.summarise_chat(formatted_msgs, group_id=group_id)
     
-    return SummaryResponse(summary=summary_text)
\ No newline at end of file
+    return SummaryResponse(summary=summary_text)
+
+
+@router.post("/groups/{group_id}/summarise_missed/stream")
+async def summarise_missed_messages_stream(
+    group_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Same as summarise_missed, streamed as plain text so the UI can render it progressively."""
+    formatted_msgs = _load_missed_messages(db, group_id, current_user)
+    if not formatted_msgs:
+        return StreamingResponse(iter(["No missed messages to summarise."]), media_type="text/plain")
+
+    return StreamingResponse(
+        summarising_agent.summarise_chat_stream(formatted_msgs, group_id=group_id),
+        media_type="text/plain"
+    )
\ No newline at end of file
@@ -1,5 +1,6 @@
 
 from fastapi import APIRouter, Depends
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 from ...core.database import get_db
 from ...core.security import get_current_user
@@ -15,15 +16,20 @@ async def get_dashboard_stats(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    total_groups = db.query(StudyGroupMembership).filter(
+    # Both counts as scalar subqueries of one SELECT: a single round-trip instead of two
+    total_groups_q = select(func.count(StudyGroupMembership.id)).where(
         StudyGroupMembership.user_id == current_user.id,
         StudyGroupMembership.is_active == True
-    ).count()
+    ).scalar_subquery()
 
-    groups_created = db.query(StudyGroup).filter(
+    groups_created_q = select(func.count(StudyGroup.id)).where(
         StudyGroup.creator_id == current_user.id,
         StudyGroup.status == StudyGroupStatus.ACTIVE
-    ).count()
+    ).scalar_subquery()
+
+    total_groups, groups_created = db.execute(
+        select(total_groups_q.label("total_groups"), groups_created_q.label("groups_created"))
+    ).one()
 
     quizzes_completed = current_user.quizzes_completed
 
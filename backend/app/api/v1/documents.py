@@ -8,7 +8,8 @@ from datetime import datetime
 
 from ...models.document_embedding import Document
 from ...services.document_service import DocumentService
-from ...models.study_group_membership import StudyGroupMembership, MemberRole
+from ...models.study_group_membership import MemberRole
+from ...services.study_group_service import StudyGroupService
 from ...core.database import get_db
 from ...core.security import get_current_user
 from ...models.user import User
@@ -18,6 +19,18 @@ router = APIRouter(prefix="/documents", tags=["documents"])
 
 ALLOWED_EXTENSIONS = {'.pdf', '.txt', '.docx', '.doc', '.md'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_READ_CHUNK = 1024 * 1024  # 1MB
+
+async def read_upload_limited(file: UploadFile, limit: int = MAX_FILE_SIZE) -> bytes:
+    """Read an upload in chunks, rejecting it (413) as soon as it exceeds `limit` bytes."""
+    buffer = bytearray()
+    while True:
+        chunk = await file.read(UPLOAD_READ_CHUNK)
+        if not chunk:
+            return bytes(buffer)
+        buffer += chunk
+        if len(buffer) > limit:
+            raise HTTPException(status_code=413, detail="File too large")
 
 def extract_text_from_file(file_content: bytes, filename: str) -> str:
     """Extract text from various file formats"""
@@ -29,10 +42,8 @@ def extract_text_from_file(file_content: bytes, filename: str) -> str:
     elif extension == '.pdf':
         try:
             pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-            return text
+            # Collect pages and join once; repeated += copies the whole text per page
+            return "\n".join([page.extract_text() or "" for page in pdf_reader.pages])
         except Exception as e:
             raise ValueError(f"Failed to extract PDF: {str(e)}")
     
@@ -57,13 +68,9 @@ async def upload_document(
     """Upload a document to a study group"""
     
     # Check if user is member of the group
-    membership = db.query(StudyGroupMembership).filter(
-        StudyGroupMembership.group_id == group_id,
-        StudyGroupMembership.user_id == current_user.id,
-        StudyGroupMembership.is_active == True
-    ).first()
+    role = StudyGroupService.get_member_role(db, group_id, current_user.id)
     
-    if not membership:
+    if role is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a member of this study group"
@@ -81,10 +88,7 @@ async def upload_document(
     
     # Read file content
     try:
-        file_bytes = await file.read()
-        
-        if len(file_bytes) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="File too large")
+        file_bytes = await read_upload_limited(file)
         
         # 1. Instantly save the file metadata and bytes to PostgreSQL
         document = DocumentService.save_document_initial(
@@ -126,19 +130,15 @@ async def get_group_documents(
     """Get all documents in a study group"""
     
     # Check if user is member of the group
-    membership = db.query(StudyGroupMembership).filter(
-        StudyGroupMembership.group_id == group_id,
-        StudyGroupMembership.user_id == current_user.id,
-        StudyGroupMembership.is_active == True
-    ).first()
+    role = StudyGroupService.get_member_role(db, group_id, current_user.id)
     
-    if not membership:
+    if role is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a member of this study group"
         )
     
-    documents = DocumentService.get_group_documents(db, group_id)
+    documents = DocumentService.get_group_documents(db, group_id, with_uploader=True)
     
     return [
         {
@@ -166,13 +166,9 @@ async def delete_document(
     """Delete a document from a study group"""
     
     # Check if user is member of the group
-    membership = db.query(StudyGroupMembership).filter(
-        StudyGroupMembership.group_id == group_id,
-        StudyGroupMembership.user_id == current_user.id,
-        StudyGroupMembership.is_active == True
-    ).first()
+    role = StudyGroupService.get_member_role(db, group_id, current_user.id)
     
-    if not membership:
+    if role is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a member of this study group"
@@ -188,7 +184,7 @@ async def delete_document(
         )
     
     # Only document uploader or group admin can delete
-    is_admin = membership.role == MemberRole.ADMIN
+    is_admin = role == MemberRole.ADMIN
     is_uploader = document.uploader_id == current_user.id
     
     if not (is_admin or is_uploader):
@@ -218,13 +214,9 @@ async def get_document(
     """Get a specific document's metadata"""
     
     # Check membership
-    membership = db.query(StudyGroupMembership).filter(
-        StudyGroupMembership.group_id == group_id,
-        StudyGroupMembership.user_id == current_user.id,
-        StudyGroupMembership.is_active == True
-    ).first()
+    role = StudyGroupService.get_member_role(db, group_id, current_user.id)
     
-    if not membership:
+    if role is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a member of this study group"
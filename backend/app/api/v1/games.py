@@ -1,4 +1,3 @@
-import mimetypes
 from typing import Dict, List, Optional
 import json
 import logging
@@ -23,6 +22,7 @@ from ...models.study_group_membership import StudyGroupMembership
 from ...services.document_service import DocumentService
 from ...models.document_embedding import Document
 from ...agents.base_llm_model import BaseLLMModel
+from ...agents.file_refs import get_mime_type
 
 router = APIRouter(prefix="/games", tags=["games"])
 
@@ -45,11 +45,12 @@ class CreateGameRequest(BaseModel):
 
 # Helper to guess mime type (mime is the file type from the binary data stored in the documents table)
 def _get_mime_type(filename: str) -> str:
-    mime, _ = mimetypes.guess_type(filename)
-    if mime: return mime
-    if filename.endswith(".pdf"): return "application/pdf"
-    if filename.endswith(".docx"): return "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    return "text/plain"
+    return get_mime_type(filename)
+
+# Patterns for parse_llm_json, compiled once at import
+_TRAILING_COMMA_RE = re.compile(r',\s*([\]}])')
+_JSON_KEYWORD_RE = re.compile(r'\b(null|true|false)\b')
+_JSON_TO_PY = {"null": "None", "true": "True", "false": "False"}
 
 # Helper for LLM response JSON Parsing
 def parse_llm_json(response_text: str):
@@ -57,12 +58,19 @@ def parse_llm_json(response_text: str):
     Robust JSON parsing for LLM outputs.
     Handles trailing commas and Python-style dicts without breaking text content.
     """
-    # 1. Extract content between first [ and last ]
-    match = re.search(r'\[.*\]', response_text, re.DOTALL)
-    if not match:
+    # 1. Drop a markdown fence if the model added one anyway (it only ever wraps head/tail)
+    text = response_text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else text[3:]
+        text = text.removesuffix("```").rstrip()
+
+    # 2. Extract content between first [ and last ]
+    start = text.find("[")
+    end = text.rfind("]")
+    if start == -1 or end < start:
         raise ValueError("No JSON list found in response")
-    
-    json_str = match.group(0)
+
+    json_str = text[start:end + 1]
 
     # Attempt 1: Standard Strict JSON
     try:
@@ -74,7 +82,7 @@ def parse_llm_json(response_text: str):
     # Regex: Finds a comma followed by whitespace and then a closing bracket/brace
     # Replaces ", ]" with "]"
     try:
-        fixed_str = re.sub(r',\s*([\]}])', r'\1', json_str)
+        fixed_str = _TRAILING_COMMA_RE.sub(r'\1', json_str)
         return json.loads(fixed_str)
     except json.JSONDecodeError:
         pass
@@ -84,10 +92,7 @@ def parse_llm_json(response_text: str):
     try:
         # Create a safe copy that maps JSON booleans/null to Python
         # Note: We use a regex word boundary \b to avoid replacing "true" inside a word
-        py_str = json_str
-        py_str = re.sub(r'\bnull\b', 'None', py_str)
-        py_str = re.sub(r'\btrue\b', 'True', py_str)
-        py_str = re.sub(r'\bfalse\b', 'False', py_str)
+        py_str = _JSON_KEYWORD_RE.sub(lambda m: _JSON_TO_PY[m.group(1)], json_str)
         return ast.literal_eval(py_str)
     except (ValueError, SyntaxError):
         pass
@@ -299,16 +304,21 @@ async def create_game(
                 Document.group_id == group_id
             ).all()
             llm_client = BaseLLMModel()
-            for doc in docs:
-                if doc.file_data:
-                    mime_type = _get_mime_type(doc.filename)
-                    try:
-                        file_ref = llm_client.upload_file_from_bytes(
-                            file_bytes=doc.file_data, mime_type=mime_type, display_name=doc.filename
-                        )
-                        uploaded_files.append(file_ref)
-                    except Exception as e:
-                        logger.error(f"Failed to upload doc: {e}")
+            # Upload all documents concurrently instead of one round trip after another
+            results = await asyncio.gather(
+                *(
+                    llm_client.aupload_file_from_bytes(
+                        file_bytes=doc.file_data, mime_type=_get_mime_type(doc.filename), display_name=doc.filename
+                    )
+                    for doc in docs if doc.file_data
+                ),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to upload doc: {result}")
+                else:
+                    uploaded_files.append(result)
 
     # 3. Generate Flashcards using LLM with File Context
     llm = BaseLLMModel()
@@ -11,6 +11,7 @@ from ...models.study_group import StudyGroup
 from ...models.study_group_membership import StudyGroupMembership, MemberRole
 from ...models.group_invitation import GroupInvitation
 from ...services.email_service import email_service
+from ...services.study_group_service import StudyGroupService
 
 router = APIRouter(prefix="/invitations", tags=["invitations"])
 
@@ -213,6 +214,7 @@ async def accept_invitation(
     
     db.add(new_membership)
     db.commit()
+    StudyGroupService.invalidate_member_roles(invitation.group_id, current_user.id)
     
     return {
         "message": "Successfully joined the study group",
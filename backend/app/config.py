@@ -113,6 +113,9 @@ class Settings(BaseSettings):
     # -------------------------
     GEMINI_API_KEY_FREE: Optional[str] = Field(default=os.getenv("GEMINI_API_KEY_FREE"))
     GEMINI_API_KEY: Optional[str] = Field(default=os.getenv("GEMINI_API_KEY"))
+    # Retrieve only the best document/conversation chunk per question: a shorter prompt and an
+    # earlier first token, at the cost of less supporting context
+    RAG_LOW_LATENCY: bool = Field(default=os.getenv("RAG_LOW_LATENCY", "false").lower() == "true")
 
     # -------------------------
     # Misc
@@ -40,6 +40,20 @@ def _import_all_models():
     from ..models.document_embedding import Document, DocumentChunk
     from ..models.conversation_embedding import ConversationChunk
 
+# create_all only creates missing tables; columns added to existing tables are applied here.
+# Every statement must be idempotent, since it runs on each startup.
+_COLUMN_MIGRATIONS = (
+    # Cached Gemini Files API handle on documents
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS gemini_file_uri VARCHAR",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS gemini_file_expires_at TIMESTAMP WITH TIME ZONE",
+)
+
+def apply_column_migrations():
+    """Add columns introduced after a table was first created (no-op when already present)."""
+    with engine.begin() as conn:
+        for statement in _COLUMN_MIGRATIONS:
+            conn.execute(text(statement))
+
 # Create tables
 def create_tables():
     """
@@ -65,5 +79,8 @@ def create_tables():
         print("🛠️  Creating database tables...")
         Base.metadata.create_all(bind=engine)
         print("✅ Database tables created successfully")
+
+        apply_column_migrations()
+        print("✅ Column migrations applied")
     except Exception as e:
         print(f"❌ Error creating tables: {e}")
\ No newline at end of file
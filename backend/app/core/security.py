@@ -1,6 +1,10 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Any, Optional, Union
-from jose import JWTError, jwt
+from typing import Any, Optional, Tuple, Union
+import jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -11,14 +15,27 @@ import os
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Checked against when the account doesn't exist, so a login for an unknown email
+# costs the same bcrypt round as a wrong password instead of returning early
+_DUMMY_PASSWORD_HASH = pwd_context.hash("dummy-password-for-timing")
 
 # JWT settings
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key")
 ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+# Allowed-algorithms list for jwt.decode, built once rather than on every decode
+ALGORITHMS = [ALGORITHM]
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 
 security = HTTPBearer()
 
+# sha256(token) -> (user id, cache expiry). Saves the JWT decode and the email lookup on
+# every authenticated request / socket connect; the short TTL bounds how long a deleted
+# user's token keeps resolving from here (the user row itself is still re-read by PK).
+_TOKEN_CACHE_TTL_SECONDS = 60
+_TOKEN_CACHE_SIZE = 10_000
+_token_cache: "OrderedDict[bytes, Tuple[Any, float]]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
 def create_access_token(
     data: dict, expires_delta: Union[timedelta, None] = None
 ):
@@ -32,12 +49,56 @@ def create_access_token(
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def verify_password(plain_password: str, hashed_password: Optional[str]) -> bool:
+    """bcrypt check (CPU-bound: call via asyncio.to_thread). A None hash still pays for one verify."""
+    if hashed_password is None:
+        pwd_context.verify(plain_password, _DUMMY_PASSWORD_HASH)
+        return False
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+def _resolve_token_user(token: str, db: Session) -> Optional[User]:
+    """User for a bearer token, or None if the token is invalid/expired or the user is gone."""
+    key = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+        if cached is not None and cached[1] <= now:
+            del _token_cache[key]
+            cached = None
+    if cached is not None:
+        user = db.get(User, cached[0])
+        if user is not None:
+            return user
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=ALGORITHMS)
+    except jwt.InvalidTokenError:
+        return None
+    email = payload.get("sub")
+    if not isinstance(email, str):
+        return None
+
+    user = db.query(User).filter(User.email == email).first()
+    if user is None:
+        return None
+
+    # Never outlive the token itself
+    expires_at = now + _TOKEN_CACHE_TTL_SECONDS
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        expires_at = min(expires_at, exp)
+    with _token_cache_lock:
+        _token_cache[key] = (user.id, expires_at)
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > _TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return user
+
+
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
@@ -48,15 +109,7 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        email: Optional[str] = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    user = db.query(User).filter(User.email == email).first()
+    user = _resolve_token_user(credentials.credentials, db)
     if user is None:
         raise credentials_exception
     
@@ -68,11 +121,4 @@ def get_user_from_token(token: str, db: Session) -> Optional[User]:
     Decodes a JWT token string and retrieves the user.
     Useful for WebSockets where HTTPBearer headers aren't available.
     """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not isinstance(email, str):
-            return None
-        return db.query(User).filter(User.email == email).first()
-    except JWTError:
-        return None
\ No newline at end of file
+    return _resolve_token_user(token, db)
\ No newline at end of file
@@ -1,4 +1,6 @@
+import asyncio
 from typing import Dict, List, Any
+import orjson
 from fastapi import WebSocket
 from ..models.user import User
 
@@ -26,6 +28,21 @@ class ConnectionManager:
         if not self.active_connections[group_id]:
             del self.active_connections[group_id]
     
+    async def _send_to_all(self, message: dict, group_id: int, websockets: List[WebSocket]):
+        """Serialize once and send to every socket concurrently; drop sockets whose send fails."""
+        if not websockets:
+            return
+        # Text frame, same as send_json, but one orjson pass shared by every socket
+        text = orjson.dumps(message).decode()
+        results = await asyncio.gather(
+            *(ws.send_text(text) for ws in websockets),
+            return_exceptions=True
+        )
+        for ws, result in zip(websockets, results):
+            if isinstance(result, Exception):
+                # If send fails, assume disconnected
+                self.disconnect(ws, group_id)
+
     def _get_unique_users_list(self, group_id: int) -> List[dict]:
         """Helper to get the unique users list for a group"""
         conns = self.active_connections.get(group_id, [])
@@ -50,11 +67,11 @@ class ConnectionManager:
         user_list = self._get_unique_users_list(group_id)
         
         try:
-            await websocket.send_json({
+            await websocket.send_text(orjson.dumps({
                 "type": "online_users_update",
                 "count": len(user_list),
                 "users": user_list
-            })
+            }).decode())
         except Exception:
             # If send fails, the socket will be cleaned up elsewhere
             pass
@@ -69,16 +86,12 @@ class ConnectionManager:
             "users": user_list
         }
         
-        # Iterate over copy of list to be safe
-        for c in list(self.active_connections.get(group_id, [])):
-            ws = c['ws']
-            if ws == exclude_websocket:
-                continue  # Skip the newly connected user
-            try:
-                await ws.send_json(message)
-            except Exception:
-                # If send fails, assume disconnected
-                self.disconnect(ws, group_id)
+        # Skip the newly connected user
+        websockets = [
+            c['ws'] for c in self.active_connections.get(group_id, [])
+            if c['ws'] != exclude_websocket
+        ]
+        await self._send_to_all(message, group_id, websockets)
     
     async def broadcast_online_users(self, group_id: int):
         """Broadcast the list of unique online users to the entire group"""
@@ -91,19 +104,14 @@ class ConnectionManager:
         }, group_id)
     
     async def broadcast_to_group(self, message: dict, group_id: int):
-        # Iterate over copy of list to be safe
-        for c in list(self.active_connections.get(group_id, [])):
-            ws = c['ws']
-            try:
-                await ws.send_json(message)
-            except Exception:
-                # If send fails, assume disconnected
-                self.disconnect(ws, group_id)
+        # Snapshot the sockets so a disconnect mid-broadcast doesn't change the list
+        websockets = [c['ws'] for c in self.active_connections.get(group_id, [])]
+        await self._send_to_all(message, group_id, websockets)
 
     async def send_personal_message(self, message: dict, websocket: WebSocket):
             """Send a message to a specific client only."""
             try:
-                await websocket.send_json(message)
+                await websocket.send_text(orjson.dumps(message).decode())
             except Exception:
                 # Handle disconnection if needed
                 pass
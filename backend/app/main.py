@@ -1,7 +1,8 @@
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
+import asyncio
 import os
 
 from .core.database import engine, create_tables, SessionLocal
@@ -19,7 +20,9 @@ app = FastAPI(
     version=settings.APP_VERSION,
     description="AI Study Group Backend API",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    # orjson encodes large payloads (e.g. /messages pages) several times faster than stdlib json
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -68,11 +71,24 @@ async def root():
         "docs": "/docs"
     }
 
+# Fire-and-forget startup work, referenced so it isn't garbage collected and cancelled on shutdown
+_background_tasks: set = set()
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 # Startup event
 @app.on_event("startup")
 async def startup_event():
     print(f"🚀 {settings.APP_NAME} v{settings.APP_VERSION} starting up...")
     print(f"📝 Documentation available at: /docs")
+
+    # Pre-open the Gemini HTTPS connections used by the chat and quiz agents
+    _spawn(chat.base_llm.warmup())
+    _spawn(quizzes.llm_model.warmup())
     
     # Automatically create the test user
     db = SessionLocal()
@@ -108,3 +124,6 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     print("👋 AI Study Group Backend shutting down...")
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
@@ -21,6 +21,10 @@ class Document(Base):
     file_data = Column(LargeBinary, nullable=True)
     status = Column(String(20), default="PENDING") # "PENDING", "COMPLETED", or "ERROR"
 
+    # Cached Gemini Files API handle so the raw bytes aren't re-uploaded on every LLM call
+    gemini_file_uri = Column(String, nullable=True)
+    gemini_file_expires_at = Column(DateTime(timezone=True), nullable=True)
+
     # Relationships
     group = relationship("StudyGroup", back_populates="documents")
     uploader = relationship("User")
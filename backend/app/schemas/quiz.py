@@ -41,6 +41,17 @@ class QuestionSchema(BaseModel):
     correct_answer: Union[str, int]
     explanation: Optional[str] = None
 
+# Structured-output schema the quiz agent hands to Gemini (response_schema),
+# so the model is constrained to this shape server-side
+class GeneratedQuestion(BaseModel):
+    question: str
+    options: List[str]
+    correct_answer: str
+    explanation: str
+
+class GeneratedQuiz(BaseModel):
+    questions: List[GeneratedQuestion]
+
 class QuizResponse(BaseModel):
     id: int
     title: str
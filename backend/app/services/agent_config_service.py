@@ -1,6 +1,7 @@
 from sqlalchemy.orm import Session
 from ..models.group_agent_config import GroupAgentConfig
 from ..agents.teaching_agent import TAConfig, RAGMode
+from ..config import settings
 
 class AgentConfigService:
     @staticmethod
@@ -40,7 +41,8 @@ class AgentConfigService:
             socratic_prompt_limit_factual=db_config.limit_factual,
             socratic_prompt_limit_conceptual=db_config.limit_conceptual,
             socratic_prompt_limit_applied=db_config.limit_applied,
-            socratic_prompt_limit_complex=db_config.limit_complex
+            socratic_prompt_limit_complex=db_config.limit_complex,
+            low_latency_rag=settings.RAG_LOW_LATENCY
         )
 
     @staticmethod
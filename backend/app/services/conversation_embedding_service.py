@@ -114,6 +114,9 @@ class ConversationEmbeddingService:
             chunk_records.append(chunk_record)
         
         db.commit()
+
+        from .rag_service import RAGService
+        RAGService.invalidate_group(group_id)
         
         # Refresh all records
         for record in chunk_records:
@@ -128,14 +131,16 @@ class ConversationEmbeddingService:
         group_id: int,
         limit: int = 5,
         similarity_threshold: float = 0.65,
-        active_only: bool = True
+        active_only: bool = True,
+        query_embedding: Optional[List[float]] = None
     ) -> List[ConversationChunk]:
         """
         Search conversation chunks by semantic similarity
         Returns the MOST RELEVANT chunks across all batches
         """
-        # Generate query embedding
-        query_embedding = embedding_service.embed_text(query_text)
+        # Generate query embedding (unless the caller already has it)
+        if query_embedding is None:
+            query_embedding = embedding_service.embed_text(query_text)
         
         # Build query with filters
         query = db.query(ConversationChunk).filter(
@@ -1,4 +1,4 @@
-from sqlalchemy.orm import Session, defer
+from sqlalchemy.orm import Session, defer, selectinload
 from typing import List, Optional
 import os
 import io
@@ -56,16 +56,18 @@ class DocumentService:
             if filename.endswith('.pdf'):
                 pdf_file = io.BytesIO(file_data)
                 reader = PyPDF2.PdfReader(pdf_file)
+                # Build the parts list and join once instead of growing a string per page
+                parts = []
                 for page in reader.pages:
                     text = page.extract_text()
                     if text:
-                        content += text + "\n"
+                        parts.append(text + "\n")
+                content = "".join(parts)
                         
             elif filename.endswith('.docx'):
                 docx_file = io.BytesIO(file_data)
                 doc = docx.Document(docx_file)
-                for para in doc.paragraphs:
-                    content += para.text + "\n"
+                content = "".join([para.text + "\n" for para in doc.paragraphs])
                     
             elif filename.endswith('.txt') or filename.endswith('.md'):
                 content = file_data.decode('utf-8', errors='ignore')
@@ -142,6 +144,9 @@ class DocumentService:
             # 4. Mark as completed
             document.status = "COMPLETED"
             db.commit()
+
+            from .rag_service import RAGService
+            RAGService.invalidate_group(document.group_id)
             
             # Optional: If you want to push a WebSocket notification to the frontend
             # from ..core.websocket_manager import manager
@@ -171,7 +176,8 @@ class DocumentService:
         query_text: str,
         group_id: Optional[int] = None,
         limit: int = 5,
-        similarity_threshold: float = 0.7
+        similarity_threshold: float = 0.7,
+        query_embedding: Optional[List[float]] = None
     ) -> List[DocumentChunk]:
         """
         Find most relevant document chunks for a query
@@ -182,9 +188,11 @@ class DocumentService:
             group_id: Optional group ID to filter results
             limit: Maximum number of results
             similarity_threshold: Minimum similarity score (0-1)
+            query_embedding: Precomputed embedding of query_text (skips re-embedding)
         """
         # Generate embedding for query
-        query_embedding = embedding_service.embed_text(query_text)
+        if query_embedding is None:
+            query_embedding = embedding_service.embed_text(query_text)
         
         # Apply threshold filter at database level
         results = db.query(DocumentChunk).join(Document).filter(
@@ -208,17 +216,31 @@ class DocumentService:
             # Cascade will delete chunks automatically
             db.delete(document)
             db.commit()
+
+            from .rag_service import RAGService
+            RAGService.invalidate_group(group_id)
             return True
         
         return False
 
 
     @staticmethod
-    def get_group_documents(db: Session, group_id: int, only_completed: bool = False):
-        """Fetch documents. Agents should set only_completed=True to avoid reading pending files."""
+    def get_group_documents(
+        db: Session,
+        group_id: int,
+        only_completed: bool = False,
+        with_uploader: bool = False
+    ):
+        """
+        Fetch documents. Agents should set only_completed=True to avoid reading pending files.
+        with_uploader=True loads every uploader in one extra query instead of one per document.
+        """
         query = db.query(Document).options(defer(Document.file_data)).filter(
             Document.group_id == group_id
         )
+
+        if with_uploader:
+            query = query.options(selectinload(Document.uploader))
         
         if only_completed:
             query = query.filter(Document.status == "COMPLETED")
@@ -1,5 +1,7 @@
 # app/services/embedding_service.py
+import threading
 import time
+from collections import OrderedDict
 
 from google import genai
 from google.genai import types
@@ -12,16 +14,60 @@ class EmbeddingService:
         self.client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
         self.model = "gemini-embedding-001"
         self.dimension = 768  # gemini-embedding-001 dimension
+        # Single-text embeddings (queries, questions) by exact text. One chat turn embeds the
+        # same question for the answer cache and for document and conversation search.
+        # Held as float32 arrays (~3 KB each) rather than lists of Python floats (~25 KB each).
+        self._cache_size = 10_000
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _cached(self, text: str) -> Optional[List[float]]:
+        with self._cache_lock:
+            embedding = self._cache.get(text)
+            if embedding is None:
+                return None
+            self._cache.move_to_end(text)
+        return embedding.tolist()
+
+    def _remember(self, text: str, embedding: List[float]) -> None:
+        with self._cache_lock:
+            self._cache[text] = np.asarray(embedding, dtype=np.float32)
+            self._cache.move_to_end(text)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
     
     def embed_text(self, text: str) -> List[float]:
         """Generate embedding for a single text"""
+        cached = self._cached(text)
+        if cached is not None:
+            return cached
         try:
             result = self.client.models.embed_content(
                 model=self.model,
                 contents=text,
                 config=types.EmbedContentConfig(output_dimensionality=768)
             )
-            return list(result.embeddings[0].values)
+            embedding = list(result.embeddings[0].values)
+            self._remember(text, embedding)
+            return embedding
+        except Exception as e:
+            print(f"Error generating embedding: {e}")
+            raise
+    
+    async def aembed_text(self, text: str) -> List[float]:
+        """Async variant of embed_text (uses the SDK's async client, no thread needed)"""
+        cached = self._cached(text)
+        if cached is not None:
+            return cached
+        try:
+            result = await self.client.aio.models.embed_content(
+                model=self.model,
+                contents=text,
+                config=types.EmbedContentConfig(output_dimensionality=self.dimension)
+            )
+            embedding = list(result.embeddings[0].values)
+            self._remember(text, embedding)
+            return embedding
         except Exception as e:
             print(f"Error generating embedding: {e}")
             raise
@@ -80,8 +126,8 @@ class EmbeddingService:
     
     def compute_similarity(self, embedding1: List[float], embedding2: List[float]) -> float:
         """Compute cosine similarity between two embeddings"""
-        vec1 = np.array(embedding1)
-        vec2 = np.array(embedding2)
+        vec1 = np.asarray(embedding1, dtype=np.float32)
+        vec2 = np.asarray(embedding2, dtype=np.float32)
         return float(np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)))
 
 embedding_service = EmbeddingService()
\ No newline at end of file
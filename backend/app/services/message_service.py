@@ -1,5 +1,5 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import inspect, or_, select
 from datetime import datetime
 from typing import List, Optional
 from uuid import UUID
@@ -39,7 +39,8 @@ class MessageService:
         offset: int = 0
     ) -> List[StudyGroupMessage]:
         """Fetch only PUBLIC messages for the group chat."""
-        return db.query(StudyGroupMessage).filter(
+        # Senders loaded in one IN query, so formatting the page doesn't query per message
+        return db.query(StudyGroupMessage).options(selectinload(StudyGroupMessage.user)).filter(
             StudyGroupMessage.group_id == group_id,
             StudyGroupMessage.is_private == False  # Filter out private chats
         ).order_by(
@@ -60,7 +61,7 @@ class MessageService:
         1. Messages sent BY the user (user_id match)
         2. Messages sent TO the user (recipient_id match, e.g., from AI)
         """
-        return db.query(StudyGroupMessage).filter(
+        return db.query(StudyGroupMessage).options(selectinload(StudyGroupMessage.user)).filter(
             StudyGroupMessage.group_id == group_id,
             StudyGroupMessage.is_private == True,
             or_(
@@ -73,10 +74,12 @@ class MessageService:
     
     @staticmethod
     def format_message_for_ws(message: StudyGroupMessage, db: Session) -> dict:
-        user = None
-        if message.user_id:
-            user = db.query(User).filter(User.id == message.user_id).first()
-        
+        # Relationship access: served from the identity map when the sender is already loaded
+        user = message.user if message.user_id else None
+        return MessageService._format_with_sender(message, user)
+
+    @staticmethod
+    def _format_with_sender(message: StudyGroupMessage, user: Optional[User]) -> dict:
         return {
             "id": message.id,
             "group_id": message.group_id,
@@ -89,4 +92,23 @@ class MessageService:
                 "username": user.username if user else "Bob the Bot", # Fallback for AI
                 "avatar": user.avatar if user else None,
             } if user or message.message_type == MessageType.AI_RESPONSE else None
-        }
\ No newline at end of file
+        }
+
+    @staticmethod
+    def format_messages_for_ws(messages: List[StudyGroupMessage], db: Session) -> List[dict]:
+        """Format a page of messages, loading any senders not already loaded in one IN query."""
+        missing_ids = {m.user_id for m in messages if m.user_id and "user" in inspect(m).unloaded}
+        senders = {}
+        if missing_ids:
+            senders = {u.id: u for u in db.execute(select(User).where(User.id.in_(missing_ids))).scalars()}
+
+        formatted = []
+        for m in messages:
+            if not m.user_id:
+                user = None
+            elif m.user_id in senders:
+                user = senders[m.user_id]
+            else:
+                user = m.user  # already loaded (e.g. selectinload in get_*_messages)
+            formatted.append(MessageService._format_with_sender(m, user))
+        return formatted
\ No newline at end of file
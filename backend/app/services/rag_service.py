@@ -1,11 +1,15 @@
+import re
+import threading
+import time
+from collections import OrderedDict
 from sqlalchemy.orm import Session
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass
 from .document_service import DocumentService
 from .conversation_embedding_service import ConversationEmbeddingService
 
 
-@dataclass
+@dataclass(slots=True)
 class RAGConfig:
     """Configuration for RAG retrieval"""
     include_documents: bool = True
@@ -19,14 +23,110 @@ class RAGConfig:
     max_conv_chars: int = 1500  # For prompt formatting
 
 
+# Retrieved + formatted context per (group, retrieval settings, normalised query).
+# Invalidated per group whenever its documents or conversation chunks change.
+RAG_CONTEXT_TTL_SECONDS = 300
+_RAG_CONTEXT_CACHE_SIZE = 512
+_context_cache: "OrderedDict[Tuple, Tuple[float, Dict[str, List[Dict[str, Any]]], str]]" = OrderedDict()
+# Formatted prompt text per retrieved chunk set, so paraphrases that retrieve the same chunks share it
+_formatted_cache: "OrderedDict[Tuple, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
 class RAGService:
-    
+
+    @staticmethod
+    def _context_cache_key(query: str, group_id: int, config: RAGConfig) -> Tuple:
+        return (
+            group_id,
+            config.include_documents,
+            config.include_conversations,
+            config.top_k_documents,
+            config.top_k_conversations,
+            config.similarity_threshold,
+            config.max_doc_chars,
+            config.max_conv_chars,
+            _WHITESPACE_RE.sub(" ", query.strip().lower()),
+        )
+
+    @staticmethod
+    def retrieve_formatted_context(
+        db: Session,
+        query: str,
+        group_id: int,
+        config: Optional[RAGConfig] = None,
+        query_embedding: Optional[List[float]] = None
+    ) -> Tuple[Dict[str, List[Dict[str, Any]]], str]:
+        """
+        retrieve_context + format_context_for_prompt behind a short TTL cache, so a repeated
+        question skips the vector search and DB round-trips.
+
+        Returns (context_dict, formatted_context).
+        """
+        if config is None:
+            config = RAGConfig()
+
+        # Embedding conversations first writes to the DB, so that mode always runs fresh
+        if config.embed_conversations_first:
+            context = RAGService.retrieve_context(db, query, group_id, config, query_embedding)
+            return context, RAGService.format_context_for_prompt(context, config)
+
+        key = RAGService._context_cache_key(query, group_id, config)
+        now = time.monotonic()
+        with _cache_lock:
+            cached = _context_cache.get(key)
+            if cached is not None and cached[0] > now:
+                _context_cache.move_to_end(key)
+                return cached[1], cached[2]
+
+        failed_sources: List[str] = []
+        context = RAGService.retrieve_context(db, query, group_id, config, query_embedding, failed_sources)
+
+        # Formatting is order-independent (see format_context_for_prompt), so key on the sorted chunk set
+        format_key = (
+            group_id,
+            tuple(sorted((d["document_id"], d["chunk_index"]) for d in context["documents"])),
+            tuple(sorted((c["batch_id"], c["chunk_index"]) for c in context["conversations"])),
+            config.max_doc_chars,
+            config.max_conv_chars,
+        )
+        with _cache_lock:
+            formatted = _formatted_cache.get(format_key)
+        if formatted is None:
+            formatted = RAGService.format_context_for_prompt(context, config)
+
+        with _cache_lock:
+            _formatted_cache[format_key] = formatted
+            _formatted_cache.move_to_end(format_key)
+            # A failed search returns partial (often empty) context; don't pin that for the TTL
+            if not failed_sources:
+                _context_cache[key] = (now + RAG_CONTEXT_TTL_SECONDS, context, formatted)
+                _context_cache.move_to_end(key)
+            while len(_context_cache) > _RAG_CONTEXT_CACHE_SIZE:
+                _context_cache.popitem(last=False)
+            while len(_formatted_cache) > _RAG_CONTEXT_CACHE_SIZE:
+                _formatted_cache.popitem(last=False)
+
+        return context, formatted
+
+    @staticmethod
+    def invalidate_group(group_id: int) -> None:
+        """Drop cached context for a group (call after its documents or conversation chunks change)."""
+        with _cache_lock:
+            for key in [k for k in _context_cache if k[0] == group_id]:
+                del _context_cache[key]
+            for key in [k for k in _formatted_cache if k[0] == group_id]:
+                del _formatted_cache[key]
+
     @staticmethod
     def retrieve_context(
         db: Session,
         query: str,
         group_id: int,
-        config: Optional[RAGConfig] = None
+        config: Optional[RAGConfig] = None,
+        query_embedding: Optional[List[float]] = None,
+        failed_sources: Optional[List[str]] = None
     ) -> Dict[str, List[Dict[str, Any]]]:
         """
         Unified RAG retrieval with flexible configuration
@@ -36,6 +136,8 @@ class RAGService:
             query: User's query
             group_id: Study group ID
             config: RAG configuration (uses default if None)
+            query_embedding: Precomputed embedding of query, shared by both searches
+            failed_sources: If given, "documents"/"conversations" is appended for each search that failed
         
         Returns:
             Dictionary with "documents" and "conversations" lists
@@ -70,7 +172,8 @@ class RAGService:
                     query_text=query,
                     group_id=group_id,
                     limit=config.top_k_documents,
-                    similarity_threshold=config.similarity_threshold
+                    similarity_threshold=config.similarity_threshold,
+                    query_embedding=query_embedding
                 )
                 
                 for chunk in doc_chunks:
@@ -83,6 +186,8 @@ class RAGService:
                     })
             except Exception as e:
                 print(f"Failed to retrieve documents: {e}")
+                if failed_sources is not None:
+                    failed_sources.append("documents")
         
         # Retrieve from conversations
         if config.include_conversations:
@@ -92,7 +197,8 @@ class RAGService:
                     query_text=query,
                     group_id=group_id,
                     limit=config.top_k_conversations,
-                    similarity_threshold=config.similarity_threshold
+                    similarity_threshold=config.similarity_threshold,
+                    query_embedding=query_embedding
                 )
                 
                 for chunk in conv_chunks:
@@ -105,6 +211,8 @@ class RAGService:
                     })
             except Exception as e:
                 print(f"Failed to retrieve conversations: {e}")
+                if failed_sources is not None:
+                    failed_sources.append("conversations")
         
         return context
     
@@ -116,6 +224,10 @@ class RAGService:
         """
         Format retrieved context into a prompt-friendly string,
         grouping chunks by their source document to prevent citation hallucinations.
+
+        Output is canonical for a given chunk set (sources by name, excerpts by chunk
+        position, discussions by batch) rather than following similarity rank, so the
+        same retrieval always yields the same bytes and keeps the prompt prefix cacheable.
         """
         if config is None:
             config = RAGConfig()
@@ -126,9 +238,10 @@ class RAGService:
         if context.get("documents"):
             formatted += "📚 Study Materials:\n"
             
-            # 1. Group the chunks by filename
+            # 1. Group the chunks by filename, in canonical order
             grouped_docs: Dict[str, List[str]] = {}
-            for doc in context["documents"]:
+            ordered_docs = sorted(context["documents"], key=lambda d: (d['source'], d.get('chunk_index', 0)))
+            for doc in ordered_docs:
                 source = doc['source']
                 if source not in grouped_docs:
                     grouped_docs[source] = []
@@ -146,7 +259,10 @@ class RAGService:
         # Format conversation context
         if context.get("conversations"):
             formatted += "\n💬 Past Discussions:\n"
-            for idx, conv in enumerate(context["conversations"], 1):
+            ordered_convs = sorted(
+                context["conversations"], key=lambda c: (c.get('batch_id') or "", c.get('chunk_index', 0))
+            )
+            for idx, conv in enumerate(ordered_convs, 1):
                 formatted += f"\n[Discussion {idx}: {conv['source']}]\n"
                 content = conv['content'][:config.max_conv_chars]
                 if len(conv['content']) > config.max_conv_chars:
@@ -0,0 +1,156 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import orjson
+
+
+@dataclass(slots=True)
+class _CacheEntry:
+    value: Any
+    expires_at: float
+    scope: Optional[str] = None
+    embedding: Optional[np.ndarray] = None
+
+
+class SemanticCache:
+    """
+    Two-tier response cache for LLM calls.
+
+    1. Exact tier: SHA-256 of the request payload.
+    2. Semantic tier: cosine similarity between request embeddings, restricted
+       to entries stored under the same scope (e.g. the same quiz). Each scope
+       keeps its normalised embeddings stacked in one matrix, so a lookup is a
+       single vectorised matrix-vector product rather than a Python loop.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold: float = 0.92,
+        ttl_seconds: float = 3600,
+        max_entries: int = 512
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        # Per-scope index: keys in row order, plus the lazily (re)built embedding matrix
+        self._scope_keys: Dict[Optional[str], List[str]] = {}
+        self._scope_matrix: Dict[Optional[str], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(payload: Any) -> str:
+        """Build a stable cache key from any JSON-serialisable payload."""
+        raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS, default=str)
+        return hashlib.sha256(raw).hexdigest()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        # float32 halves the per-scope matrices and the matvec cost; cosine ranking is unaffected
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return None
+        return vec / norm
+
+    def _remove(self, key: str) -> None:
+        """Drop an entry and its row in the scope index. Caller holds the lock."""
+        entry = self._entries.pop(key, None)
+        if entry is None or entry.embedding is None:
+            return
+        keys = self._scope_keys.get(entry.scope)
+        if keys is not None and key in keys:
+            keys.remove(key)
+            self._scope_matrix.pop(entry.scope, None)
+            if not keys:
+                del self._scope_keys[entry.scope]
+
+    def get(self, key: str) -> Optional[Any]:
+        """Exact-match lookup."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def get_similar(self, embedding: List[float], scope: Optional[str] = None) -> Optional[Any]:
+        """Return the closest cached value in `scope` if it clears the similarity threshold."""
+        query = self._normalize(embedding)
+        if query is None:
+            return None
+
+        now = time.monotonic()
+
+        with self._lock:
+            keys = self._scope_keys.get(scope)
+            if not keys:
+                return None
+
+            matrix = self._scope_matrix.get(scope)
+            if matrix is None:
+                matrix = np.vstack([self._entries[k].embedding for k in keys])
+                self._scope_matrix[scope] = matrix
+
+            scores = matrix @ query
+            best_key = None
+            expired = []
+            for idx in np.argsort(-scores):
+                if scores[idx] < self.similarity_threshold:
+                    break
+                key = keys[idx]
+                if self._entries[key].expires_at < now:
+                    expired.append(key)
+                    continue
+                best_key = key
+                break
+
+            # Expired entries are only found (and purged) when they would have matched
+            for key in expired:
+                self._remove(key)
+
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key].value
+
+    def set(
+        self,
+        key: str,
+        value: Any,
+        embedding: Optional[List[float]] = None,
+        scope: Optional[str] = None
+    ) -> None:
+        entry = _CacheEntry(
+            value=value,
+            expires_at=time.monotonic() + self.ttl_seconds,
+            scope=scope,
+            embedding=self._normalize(embedding) if embedding is not None else None
+        )
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            if entry.embedding is not None:
+                self._scope_keys.setdefault(scope, []).append(key)
+                self._scope_matrix.pop(scope, None)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_scope(self, scope: str) -> None:
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.scope == scope]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._scope_keys.clear()
+            self._scope_matrix.clear()
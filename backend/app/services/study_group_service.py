@@ -1,17 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_
 from fastapi import HTTPException, status
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from ..models.study_group import StudyGroup, StudyGroupStatus
 from ..models.study_group_membership import StudyGroupMembership, MemberRole
 from ..models.study_group_message import StudyGroupMessage, MessageType
 from ..schemas.study_group import CreateStudyGroupRequest, UpdateStudyGroupRequest
 
+# (group_id, user_id) -> (role of the active membership or None, expires_at). Checked by every
+# document/chat/agent-config request; join, leave and delete invalidate it in this process,
+# and the TTL bounds how long another worker can serve a stale answer.
+_MEMBER_ROLE_TTL_SECONDS = 30.0
+_MEMBER_ROLE_CACHE_SIZE = 10_000
+_member_roles: "OrderedDict[Tuple[int, int], Tuple[Optional[MemberRole], float]]" = OrderedDict()
+# Sync endpoints run in the threadpool
+_member_roles_lock = threading.Lock()
+
 class StudyGroupService:
 
     active_chat_sessions = {}
     
+    @staticmethod
+    def get_member_role(db: Session, group_id: int, user_id) -> Optional[MemberRole]:
+        """Role of the user's active membership in the group (None if not a member), briefly cached."""
+        key = (group_id, user_id)
+        now = time.monotonic()
+        with _member_roles_lock:
+            cached = _member_roles.get(key)
+            if cached is not None and cached[1] > now:
+                _member_roles.move_to_end(key)
+                return cached[0]
+
+        row = db.query(StudyGroupMembership.role).filter(
+            StudyGroupMembership.group_id == group_id,
+            StudyGroupMembership.user_id == user_id,
+            StudyGroupMembership.is_active == True
+        ).first()
+        role = row[0] if row else None
+
+        with _member_roles_lock:
+            _member_roles[key] = (role, now + _MEMBER_ROLE_TTL_SECONDS)
+            _member_roles.move_to_end(key)
+            while len(_member_roles) > _MEMBER_ROLE_CACHE_SIZE:
+                _member_roles.popitem(last=False)
+        return role
+
+    @staticmethod
+    def invalidate_member_roles(group_id: int, user_id=None):
+        """Forget cached roles for one member, or for the whole group when user_id is None."""
+        with _member_roles_lock:
+            if user_id is not None:
+                _member_roles.pop((group_id, user_id), None)
+                return
+            for key in [k for k in _member_roles if k[0] == group_id]:
+                del _member_roles[key]
+
     @staticmethod
     def mark_user_online(group_id: int, user_id: int):
         """Mark user as online in a specific group"""
@@ -209,6 +256,7 @@ class StudyGroupService:
         db.add(join_msg)
         
         db.commit()
+        StudyGroupService.invalidate_member_roles(group_id, user_id)
         db.refresh(membership)
         return membership
 
@@ -255,6 +303,8 @@ class StudyGroupService:
         db.add(leave_msg)
         
         db.commit()
+        # Whole group: leaving may also have promoted another member to admin
+        StudyGroupService.invalidate_member_roles(group_id)
 
     @staticmethod
     def update_group(db: Session, group_id: int, user_id: int, update_data: UpdateStudyGroupRequest) -> StudyGroup:
@@ -321,6 +371,7 @@ class StudyGroupService:
         ).update({"is_active": False})
         
         db.commit()
+        StudyGroupService.invalidate_member_roles(group_id)
 
     @staticmethod
     def get_user_groups(db: Session, user_id: int, page: int = 1, size: int = 10):